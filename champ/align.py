@@ -2,115 +2,422 @@ import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 from champ.grid import GridImages
-from champ import plotting, fastqimagealigner, stats, error
-from collections import Counter, defaultdict
+from champ import grid, plotting, fastqimagealigner, fastqtilercs, stagemodel, error, lease, readrcs, ledger
+import collections
+from collections import Counter
 import functools
+import itertools
 import h5py
 import logging
 import multiprocessing
-from multiprocessing import Manager
 import os
+import shutil
 import sys
-import re
-from copy import deepcopy
+import tempfile
+import time
 import math
-import gc
+import numpy as np
 
 log = logging.getLogger(__name__)
-stats_regex = re.compile(r'''^(\w+)_(?P<row>\d+)_(?P<column>\d+)_stats\.txt$''')
-
-
-def run(cluster_strategy, rotation_adjustment, h5_filenames, path_info, snr, min_hits, fia, end_tiles, alignment_channel, all_tile_data, metadata, make_pdfs, sequencing_chip, process_limit, side1):
-    image_count = count_images(h5_filenames, alignment_channel)
-    num_processes, chunksize = calculate_process_count(image_count)
-    if process_limit > 0:
-        num_processes = min(process_limit, num_processes)
-    log.debug("Aligning alignment images with %d cores with chunksize %d" % (num_processes, chunksize))
+# The number of images that are aligned the usual way before the stage model is fit
+STAGE_MODEL_SAMPLE_SIZE = 16
+# With a learned tile map, the rough alignment stops once a tile beats the SNR threshold by this factor
+EARLY_EXIT_SNR_FACTOR = 2.0
+# The number of images whose control correlations are measured to estimate the noise floor
+NOISE_FLOOR_SAMPLE_SIZE = 16
+# An alignment found near a prediction is only kept if it has at least this fraction of the exclusive hits of the images
+# that it was predicted from. Ones that are a few pixels off can still get far more than --min-hits.
+MIN_PREDICTED_HIT_FRACTION = 0.7
+# Workers are replaced after this many tasks (single images, or chunks of them when they're mapped) unless
+# --max-tasks-per-worker says otherwise. A new worker starts with an empty tile spectrum cache and attaches to the tile
+# stores again, so this trades some speed for memory that would otherwise pile up.
+MAX_TASKS_PER_WORKER = 100
+# How often (in seconds) find_bounds checks on the columns that it's waiting for
+END_TILE_POLL_INTERVAL = 0.1
+# Fills in the gaps when interleaving lists of different lengths
+_missing = object()
+
+
+def run(cluster_strategy, rotation_adjustment, h5_filenames, path_info, snr, min_hits, alignment_tile_store, end_tiles, alignment_channel, all_tile_store, metadata, make_pdfs, sequencing_chip, pool, process_limit, side1, pyramid_levels, fourier_mellin, refinement_iterations, neighbor_priors,
+        use_stage_model, stage_model, learn_tile_map, noise_floors=None, single_precision=False, window_margin=None, binary_output=False, data_processors=(), leases=None):
+    leases = leases or lease.LocalLeases()
+    num_processes = calculate_process_count(process_limit)
+    log.debug("Aligning alignment images with %d cores" % num_processes)
 
     # Iterate over images that are probably inside an Illumina tile, attempt to align them, and if they
     # align, do a precision alignment and write the mapped FastQ reads to disk
-    alignment_func = functools.partial(perform_alignment, cluster_strategy, rotation_adjustment, path_info, snr, min_hits, metadata['microns_per_pixel'],
-                                       sequencing_chip, all_tile_data, make_pdfs, fia, side1)
+    base_alignment_func = functools.partial(perform_alignment, cluster_strategy, rotation_adjustment, path_info, snr, min_hits, metadata['microns_per_pixel'],
+                                            sequencing_chip, all_tile_store, make_pdfs, alignment_tile_store, side1, pyramid_levels, fourier_mellin, refinement_iterations,
+                                            neighbor_priors, learn_tile_map, single_precision, window_margin, binary_output)
 
+    images = {h5_filename: list(iterate_all_images([h5_filename], end_tiles, alignment_channel, path_info)) for h5_filename in h5_filenames}
+    h5_alignment_funcs = {}
     for h5_filename in h5_filenames:
-        pool = multiprocessing.Pool(num_processes)
-        pool.map_async(alignment_func,
-                       iterate_all_images([h5_filename], end_tiles, alignment_channel, path_info), chunksize=chunksize).get(timeout=sys.maxint)
-        pool.close()
-        pool.join()
+        noise_floor = None
+        if noise_floors is not None:
+            # The noise floor is kept in the run cache, so it's only estimated once for each HDF5 file and channel
+            h5_noise_floors = noise_floors.setdefault(h5_filename, {})
+            if alignment_channel not in h5_noise_floors:
+                measure_func = functools.partial(measure_control_correlation, rotation_adjustment, metadata['microns_per_pixel'],
+                                                 sequencing_chip, alignment_tile_store, side1, single_precision)
+                noise_floor = estimate_noise_floor(pool, measure_func, images[h5_filename])
+                if noise_floor is not None:
+                    h5_noise_floors[alignment_channel] = noise_floor
+            noise_floor = h5_noise_floors.get(alignment_channel)
+        h5_alignment_funcs[h5_filename] = functools.partial(base_alignment_func, noise_floor)
+    # Other processes working on the same run skip the images that we hold the lease for, and vice versa
+    image_lease_key = functools.partial(image_data_lease_key, alignment_channel)
+    stats_file_lease_key = functools.partial(aligned_stats_file_lease_key, alignment_channel)
+    # The data channels of the images that were aligned before can start right away. The ones that are aligned in this
+    # run (including the stage model sample) are queued once they're aligned.
+    queued = set((image_data[3], image_data[0], image_data[1]) for h5_images in images.values() for image_data in h5_images)
+    if use_stage_model and stage_model is None:
+        # Align a sample of images spread over the chip the usual way, and then fit the model to them
+        h5_filename = h5_filenames[0]
+        sample = images[h5_filename][::max(1, len(images[h5_filename]) // STAGE_MODEL_SAMPLE_SIZE)]
+        log.debug("Aligning %d images to fit the stage model" % len(sample))
+        for claimed in leases.rounds(sample, image_lease_key):
+            claimed = list(claimed)
+            results = pool.map_async(functools.partial(h5_alignment_funcs[h5_filename], None), claimed, chunksize=1).get(timeout=sys.maxint)
+            # like in the main loop, the lease of a sampled image is held until its data channels are aligned too, since
+            # the same lease marks them as done
+            finish_data_channel_jobs(leases, [(image_lease_key(image_data), queue_data_channel_jobs(pool, data_processors, [aligned_stats_file])
+                                               if aligned_stats_file is not None else [])
+                                              for image_data, aligned_stats_file in zip(claimed, results)])
+        stage_model = stagemodel.StageModel.fit(load_stage_observations(h5_filenames, alignment_channel, path_info))
+        images[h5_filename] = [image_data for image_data in images[h5_filename] if image_data not in sample]
+        if stage_model is not None and not any(images.values()):
+            log.info("The stage model was fit to all %d images, so it isn't used to predict any alignments in this run" % len(sample))
+
+    # Images from all of the HDF5 files go into one queue, so no cores sit idle while the last images of a file finish
+    h5_alignment_funcs = {h5_filename: functools.partial(func, stage_model) for h5_filename, func in h5_alignment_funcs.items()}
+    tasks = list(interleave(*[[(h5_alignment_funcs[h5_filename], image_data) for image_data in images[h5_filename]]
+                              for h5_filename in h5_filenames]))
+    aligned_rounds = leases.rounds([stats_file for stats_file in load_aligned_stats_files(h5_filenames, alignment_channel, path_info)
+                                    if (stats_file[0], stats_file[3], stats_file[4]) not in queued], stats_file_lease_key)
+    # The lease of an image is held until its data channels are aligned too
+    data_jobs = [(stats_file_lease_key(stats_file), queue_data_channel_jobs(pool, data_processors, [stats_file]))
+                 for stats_file in next(aligned_rounds, ())]
+    for claimed in leases.rounds(tasks, functools.partial(task_lease_key, image_lease_key)):
+        claimed_tasks = collections.deque()
+        for aligned_stats_file in stream_tasks(pool, claimed_tasks_of(claimed, claimed_tasks), 2 * num_processes):
+            key = image_lease_key(claimed_tasks.popleft()[1])
+            if aligned_stats_file is None:
+                leases.release(key)
+            else:
+                data_jobs.append((key, queue_data_channel_jobs(pool, data_processors, [aligned_stats_file])))
+        finish_data_channel_jobs(leases, data_jobs)
+        data_jobs = []
+    # if there were no images to align, the data channels of the first round haven't been waited for yet
+    finish_data_channel_jobs(leases, data_jobs)
+    for claimed in aligned_rounds:
+        finish_data_channel_jobs(leases, [(stats_file_lease_key(stats_file), queue_data_channel_jobs(pool, data_processors, [stats_file]))
+                                          for stats_file in claimed])
 
     log.debug("Done aligning!")
+    return stage_model
+
+
+def data_channel_processor(cluster_strategy, channel_name, path_info, alignment_tile_store, all_tile_store, clargs):
+    # Aligns the data channel of one image, given its stats file from load_aligned_stats_files. The workers attach to the
+    # reads in the tile stores, so only their locations get pickled.
+    return functools.partial(process_data_image, cluster_strategy, path_info, all_tile_store,
+                             clargs.microns_per_pixel, clargs.make_pdfs,
+                             channel_name, alignment_tile_store, clargs.min_hits, clargs.refinement_iterations, clargs.binary_output)
+
+
+def run_data_channels(h5_filenames, data_processors, metadata, path_info, pool, process_limit, leases=None):
+    # Aligns the data channels of every image that has already been aligned, for all of the data processors at once
+    leases = leases or lease.LocalLeases()
+    stats_files = list(interleave(*[list(load_aligned_stats_files([h5_filename], metadata['alignment_channel'], path_info))
+                                    for h5_filename in h5_filenames]))
+    stats_file_lease_key = functools.partial(aligned_stats_file_lease_key, 'data')
+    num_processes = calculate_process_count(process_limit)
+    for claimed in leases.rounds(stats_files, stats_file_lease_key):
+        claimed = list(claimed)
+        tasks = [(data_processor, stats_file) for stats_file in claimed for data_processor in data_processors]
+        chunksize = calculate_chunksize(len(tasks), num_processes)
+        log.debug("Doing data channel alignment of %d images with %d cores with chunksize %d" % (len(tasks), num_processes, chunksize))
+        pool.map_async(run_task, tasks, chunksize=chunksize).get(sys.maxint)
+        for stats_file in claimed:
+            leases.release(stats_file_lease_key(stats_file))
 
+    log.debug("Done aligning!")
 
-def run_data_channel(cluster_strategy, h5_filenames, channel_name, path_info, alignment_tile_data, all_tile_data, metadata, clargs, process_limit):
-    image_count = count_images(h5_filenames, channel_name)
-    num_processes, chunksize = calculate_process_count(image_count)
-    if process_limit > 0:
-        num_processes = min(process_limit, num_processes)
-    log.debug("Aligning data images with %d cores with chunksize %d" % (num_processes, chunksize))
-
-    # Here we load only the phiX reads to FASTQ Image Aligner
-    log.debug("Loading reads into FASTQ Image Aligner.")
-    fastq_image_aligner = fastqimagealigner.FastqImageAligner(metadata['microns_per_pixel'])
-    fastq_image_aligner.load_reads(alignment_tile_data)
-    log.debug("Reads loaded.")
-    second_processor = functools.partial(process_data_image, cluster_strategy, path_info, all_tile_data,
-                                         clargs.microns_per_pixel, clargs.make_pdfs,
-                                         channel_name, fastq_image_aligner, clargs.min_hits)
-    for h5_filename in h5_filenames:
-        pool = multiprocessing.Pool(num_processes)
-        log.debug("Doing second channel alignment of all images with %d cores" % num_processes)
-        pool.map_async(second_processor,
-                       load_aligned_stats_files([h5_filename], metadata['alignment_channel'], path_info),
-                       chunksize=chunksize).get(sys.maxint)
-        pool.close()
-        pool.join()
-        gc.collect()
 
-    log.debug("Done aligning!")
+def queue_data_channel_jobs(pool, data_processors, stats_files):
+    return [pool.apply_async(data_processor, (stats_file,)) for stats_file in stats_files for data_processor in data_processors]
 
 
-def alignment_is_complete(stats_file_path):
-    existing_score = load_existing_score(stats_file_path)
-    if existing_score > 0:
-        return True
-    return False
+def finish_data_channel_jobs(leases, data_jobs):
+    # Waits for the (lease key, jobs) of each image and releases its lease
+    if data_jobs:
+        log.debug("Waiting for the data channel alignments of %d images" % len(data_jobs))
+    for key, jobs in data_jobs:
+        for job in jobs:
+            job.get(sys.maxint)
+        leases.release(key)
+
+
+def claimed_tasks_of(claimed, claimed_tasks):
+    # Keeps track of the tasks that stream_tasks has taken, in order, so that their results can be matched up with them
+    for task in claimed:
+        claimed_tasks.append(task)
+        yield task
+
+
+def alignment_lease_key(channel, h5_filename, row, column):
+    return '%s_%s_%d_%d' % (channel, os.path.basename(os.path.splitext(h5_filename)[0]), row, column)
+
+
+def image_data_lease_key(channel, (row, column, _, h5_filename, possible_tile_keys, base_name)):
+    return alignment_lease_key(channel, h5_filename, row, column)
+
+
+def aligned_stats_file_lease_key(channel, (h5_filename, base_name, stats_filepath, row, column)):
+    return alignment_lease_key(channel, h5_filename, row, column)
+
+
+def task_lease_key(image_lease_key, (func, image_data)):
+    return image_lease_key(image_data)
+
 
+def stream_tasks(pool, tasks, window):
+    """
+    Runs (function, argument) tasks in the pool and yields their results in order. Only a few more tasks than there are
+    workers are queued at any time, so anything that the caller queues in response to a result runs before the rest of
+    the tasks instead of after all of them.
 
-def perform_alignment(cluster_strategy, rotation_adjustment, path_info, snr, min_hits, um_per_pixel, sequencing_chip, all_tile_data,
-                      make_pdfs, prefia, side1, image_data):
+    """
+    pending = collections.deque()
+    for task in tasks:
+        pending.append(pool.apply_async(run_task, (task,)))
+        if len(pending) >= window:
+            yield pending.popleft().get(sys.maxint)
+    while pending:
+        yield pending.popleft().get(sys.maxint)
+
+
+def create_pool(process_limit, spectrum_cache_mb=None, max_tasks_per_worker=None):
+    """
+    Creates the worker pool that all of the alignment work of a run is done in. Workers are replaced after
+    max_tasks_per_worker tasks (MAX_TASKS_PER_WORKER by default, 0 for never), which gives back the memory that numpy and
+    HDF5 hold on to between images. The tile spectrum cache doesn't need this, since it stays within its share of the
+    memory (see fastqtilercs.spectrum_cache_budget), but it's lost along with the worker.
+
+    """
+    num_processes = calculate_process_count(process_limit)
+    spectrum_cache_bytes = fastqtilercs.spectrum_cache_budget(num_processes, spectrum_cache_mb)
+    if max_tasks_per_worker is None:
+        max_tasks_per_worker = MAX_TASKS_PER_WORKER
+    log.debug("Each worker caches up to %d MB of tile spectra and is replaced after %s tasks"
+              % (spectrum_cache_bytes // 1024 ** 2, max_tasks_per_worker or 'no'))
+    return multiprocessing.Pool(num_processes, fastqtilercs.set_spectrum_cache_budget, (spectrum_cache_bytes,),
+                                maxtasksperchild=max_tasks_per_worker or None)
+
+
+def run_in_order(funcs, args):
+    for func in funcs:
+        func(args)
+
+
+def run_task((func, args)):
+    # Lets one pool run tasks that need different functions
+    return func(args)
+
+
+def interleave(*iterables):
+    # Takes one item from each iterable in turn
+    for items in itertools.izip_longest(*iterables, fillvalue=_missing):
+        for item in items:
+            if item is not _missing:
+                yield item
+
+
+def load_ledger(path_info):
+    # Shared runs can't use the SQLite ledger, see ledger.load
+    return ledger.load(path_info.results_directory, path_info.shared_run)
+
+
+def alignment_is_complete(path_info, base_name, image_index):
+    return load_ledger(path_info).score(base_name, image_index) > 0
+
+
+def perform_alignment(cluster_strategy, rotation_adjustment, path_info, snr, min_hits, um_per_pixel, sequencing_chip, all_tile_store,
+                      make_pdfs, alignment_tile_store, side1, pyramid_levels, fourier_mellin, refinement_iterations, neighbor_priors,
+                      learn_tile_map, single_precision, window_margin, binary_output, noise_floor, stage_model, image_data):
     # Does a rough alignment, and if that works, does a precision alignment and writes the corrected
-    # FastQ reads to disk
+    # FastQ reads to disk. Returns the stats file in the format that load_aligned_stats_files yields if the image is
+    # aligned, so that its data channels can be aligned next.
+    row, column, channel, h5_filename, possible_tile_keys, base_name = image_data
+    started = time.time()
     try:
-        row, column, channel, h5_filename, possible_tile_keys, base_name = image_data
-
         image = load_image(h5_filename, channel, row, column)
         stats_file_path = os.path.join(path_info.results_directory, base_name, '{}_stats.txt'.format(image.index))
-        if alignment_is_complete(stats_file_path):
+        aligned_stats_file = h5_filename, base_name, os.path.basename(stats_file_path), row, column
+        if alignment_is_complete(path_info, base_name, image.index):
             log.debug("Already aligned %s from %s" % (image.index, h5_filename))
-            return
+            return aligned_stats_file
 
         log.debug("Aligning image from %s. Row: %d, Column: %d " % (base_name, image.row, image.column))
+        align_near_prediction = functools.partial(precision_align_from_prior, cluster_strategy, rotation_adjustment, snr,
+                                                  sequencing_chip, base_name, um_per_pixel, image, alignment_tile_store, side1,
+                                                  min_hits=min_hits, refinement_iterations=refinement_iterations,
+                                                  window_margin=window_margin, single_precision=single_precision)
+        fia = None
+        if neighbor_priors:
+            # If the images next to this one are aligned, we can predict where this one is and only search near there
+            alignments, exclusive_hits = predict_alignment_from_neighbors(load_ledger(path_info), base_name, channel, row, column)
+            fia = align_near_prediction(alignments, exclusive_hits) if alignments else None
+        if fia is None and stage_model is not None:
+            alignments = stage_model.predict(row, column, image.shape, alignment_tile_store.tile_bounds)
+            fia = align_near_prediction(alignments, stage_model.exclusive_hits) if alignments else None
+            if fia is not None:
+                stage_model.log_residuals(image.index, row, column, fia.alignment_stats)
+        if fia is not None:
+            result = write_output(stats_file_path, image, base_name, fia, path_info, all_tile_store, make_pdfs, um_per_pixel, binary_output,
+                                  cluster_strategy, started)
+            log.debug("Write alignment for %s: %s" % (image.index, result))
+            return aligned_stats_file
+        early_exit_snr, likely_tile_count = None, 0
+        if learn_tile_map:
+            # Try the tile(s) that the aligned images in this column hit first, and only try the others if that fails
+            hitting_tile_counts, aligned_image_count = count_hitting_tiles(load_ledger(path_info), base_name, channel, column)
+            likely_tile_keys, other_tile_keys = sequencing_chip.rank_expected_tiles(possible_tile_keys, hitting_tile_counts,
+                                                                                    aligned_image_count)
+            possible_tile_keys = likely_tile_keys + other_tile_keys
+            early_exit_snr, likely_tile_count = EARLY_EXIT_SNR_FACTOR * snr, len(likely_tile_keys)
         # first get the correlation to random tiles, so we can distinguish signal from noise
-        fia = process_alignment_image(cluster_strategy, rotation_adjustment, snr, sequencing_chip, base_name, um_per_pixel, image, possible_tile_keys, deepcopy(prefia), side1)
+        fia = process_alignment_image(cluster_strategy, rotation_adjustment, snr, sequencing_chip, base_name, um_per_pixel, image, possible_tile_keys, load_aligner(alignment_tile_store, um_per_pixel), side1, pyramid_levels, fourier_mellin,
+                                      early_exit_snr, likely_tile_count, noise_floor, single_precision)
 
         if fia.hitting_tiles:
             # The image data aligned with FastQ reads!
             try:
-                fia.precision_align_only(min_hits=min_hits)
+                fia.precision_align_only(min_hits=min_hits, refinement_iterations=refinement_iterations)
             except ValueError:
             # If the 'exclusive hits' + 'good-mutual hits' smaller than the user-defined threshold (i.e., '--min-hits'), it is not considered as a successful alignment.
                 log.debug("Too few hits to perform precision alignment. Image: %s Row: %d Column: %d " % (base_name, image.row, image.column))
             else:
-                result = write_output(stats_file_path, image.index, base_name, fia, path_info, all_tile_data, make_pdfs, um_per_pixel)
-                print("Write alignment for %s: %s" % (image.index, result))
-        # Force the GC to run, since otherwise memory usage blows up
-        del fia
-        del image
-        gc.collect()
+                result = write_output(stats_file_path, image, base_name, fia, path_info, all_tile_store, make_pdfs, um_per_pixel, binary_output,
+                                  cluster_strategy, started)
+                log.debug("Write alignment for %s: %s" % (image.index, result))
+                return aligned_stats_file
     except IndexError:
         # This happens and we don't know why. We'll just throw out the data since it's very rare
         pass
+    load_ledger(path_info).record_failure(base_name, grid.Image.index_format(channel, row, column), channel, row,
+                                          column, cluster_strategy, started, time.time())
+
+
+def load_stage_observations(h5_filenames, alignment_channel, path_info):
+    # Yields the (row, column, AlignmentStats) of every image that was aligned without a prediction, which is what the
+    # stage model is fit to
+    alignment_ledger = load_ledger(path_info)
+    for h5_filename in h5_filenames:
+        for row, column, astats in alignment_ledger.aligned_stats(os.path.splitext(h5_filename)[0], alignment_channel):
+            if not astats.predicted:
+                yield row, column, astats
+
+
+def estimate_noise_floor(pool, measure_func, images):
+    """
+    Measures the control correlations of a sample of images spread over the chip. Returns the lowest, median and highest
+    of them, or None if there are no images to sample.
+
+    """
+    sample = images[::max(1, len(images) // NOISE_FLOOR_SAMPLE_SIZE)]
+    control_correlations = [corr for corr in pool.map(measure_func, sample, chunksize=1) if corr is not None]
+    if not control_correlations:
+        return None
+    noise_floor = [float(np.min(control_correlations)), float(np.median(control_correlations)), float(np.max(control_correlations))]
+    log.info("Noise floor from %d images: median control correlation %.2f (%.2f - %.2f)"
+             % (len(control_correlations), noise_floor[1], noise_floor[0], noise_floor[2]))
+    return noise_floor
+
+
+def measure_control_correlation(rotation_adjustment, um_per_pixel, sequencing_chip, alignment_tile_store, side1, single_precision, image_data):
+    row, column, channel, h5_filename, possible_tile_keys, base_name = image_data
+    image = load_image(h5_filename, channel, row, column)
+    if image is None:
+        return None
+    fia = load_aligner(alignment_tile_store, um_per_pixel)
+    fia.set_image_data(image, um_per_pixel, single_precision)
+    return fia.control_correlation(side1, possible_tile_keys, sequencing_chip.rotation_estimate + rotation_adjustment,
+                                   sequencing_chip.tile_width)
+
+
+def count_hitting_tiles(alignment_ledger, base_name, channel, column):
+    # How often each tile was hit by the images in a column that are already aligned, and how many images that is
+    hitting_tile_counts = Counter()
+    aligned_stats = alignment_ledger.aligned_stats(base_name, channel, column)
+    for _, _, astats in aligned_stats:
+        hitting_tile_counts.update(set(tile_key for tile_key, _, _, _, _, _ in astats))
+    return hitting_tile_counts, len(aligned_stats)
+
+
+def predict_alignment_from_neighbors(alignment_ledger, base_name, channel, row, column):
+    """
+    Predicts the alignment of an image from the two closest aligned images on either side of it in the same row. Images
+    are taken on a regular grid, so the offset changes by the same stage step from one column to the next, while the
+    rotation and scale don't change at all. Only tiles that both neighbors aligned to can be predicted. Neighbors that
+    were aligned from a prediction themselves aren't used, since the error of each prediction would add up along the row.
+
+    Returns a list of (tile_key, scaling, tile_width, rotation, rc_offset) tuples and the mean number of exclusive hits of
+    the two neighbors, or (None, None).
+
+    """
+    def load_stats(c):
+        alignment_stats = alignment_ledger.alignment_stats(base_name, grid.Image.index_format(channel, row, c))
+        return alignment_stats if alignment_stats is not None and not alignment_stats.predicted else None
+
+    for direction in (-1, 1):
+        near_stats = load_stats(column + direction)
+        far_stats = load_stats(column + 2 * direction) if near_stats is not None else None
+        if far_stats is None:
+            continue
+        far_offsets = {tile_key: np.array(rc_offset) for tile_key, _, _, _, rc_offset, _ in far_stats}
+        alignments = []
+        for tile_key, scaling, tile_width, rotation, rc_offset, _ in near_stats:
+            if tile_key in far_offsets:
+                stage_step = np.array(rc_offset) - far_offsets[tile_key]
+                alignments.append((tile_key, scaling, tile_width, rotation, np.array(rc_offset) + stage_step))
+        if alignments:
+            return alignments, np.mean([near_stats.hits['exclusive'], far_stats.hits['exclusive']])
+    return None, None
+
+
+def precision_align_from_prior(cluster_strategy, rotation_adjustment, snr, sequencing_chip, base_name, um_per_pixel, image,
+                               alignment_tile_store, side1, alignments, expected_exclusive_hits, min_hits, refinement_iterations,
+                               window_margin=None, single_precision=False):
+    """
+    Aligns an image near predicted tile alignments instead of searching the whole tiles. A prediction that is a few pixels
+    off can still get plenty of hits in the precision alignment, so it's only used to decide where to look: a windowed
+    rough alignment (see FastqImageAligner.rough_align_in_windows) finds where the tiles really are within window_margin
+    pixels of it, and the precision alignment starts from there.
+
+    Returns the aligner if that worked, or None if the tiles weren't found near the prediction, there were too few hits, or
+    far fewer exclusive hits than expected_exclusive_hits (the number that the images it was predicted from have).
+
+    """
+    fia = process_alignment_image(cluster_strategy, rotation_adjustment, snr, sequencing_chip, base_name, um_per_pixel, image, None,
+                                  load_aligner(alignment_tile_store, um_per_pixel), side1, single_precision=single_precision,
+                                  predicted_alignments=alignments, window_margin=window_margin)
+    if not fia.hitting_tiles:
+        log.debug("No tiles near the predicted alignment of %s, falling back to rough alignment." % image.index)
+        return None
+    try:
+        fia.precision_align_only(min_hits, refinement_iterations)
+    except ValueError:
+        log.debug("Predicted alignment of %s has too few hits, falling back to rough alignment." % image.index)
+        return None
+    if expected_exclusive_hits and len(fia.exclusive_hits) < MIN_PREDICTED_HIT_FRACTION * expected_exclusive_hits:
+        log.debug("Predicted alignment of %s has %d exclusive hits instead of about %d, falling back to rough alignment."
+                  % (image.index, len(fia.exclusive_hits), expected_exclusive_hits))
+        return None
+    log.debug("Aligned %s near its predicted alignment" % image.index)
+    fia.predicted = True
+    return fia
 
 
 def make_output_directories(h5_filenames, path_info):
@@ -122,7 +429,8 @@ def make_output_directories(h5_filenames, path_info):
                 os.makedirs(full_directory)
 
 
-def get_end_tiles(cluster_strategies, rotation_adjustment, h5_filenames, alignment_channel, snr, metadata, sequencing_chip, fia, side1):
+def get_end_tiles(cluster_strategies, rotation_adjustment, h5_filenames, alignment_channel, snr, metadata, sequencing_chip, alignment_tile_store, side1, pyramid_levels, fourier_mellin,
+                  single_precision, pool, process_limit):
 
     # -----------------------------------
     # To reduce the time for alignment, champ program strategically find the image boundary in the FASTQ space by aligning the first image to the tiles #2101 to # 2109,
@@ -134,17 +442,17 @@ def get_end_tiles(cluster_strategies, rotation_adjustment, h5_filenames, alignme
     left_end_tiles = {}
     # For rough alignment, we first try ".se" strategy from source extractor. If it .se strategy fails, champ then try with ".otsu" from Otsu's method.
     for cluster_strategy in cluster_strategies:
-        with h5py.File(h5_filenames[0]) as first_file:
+        with h5py.File(h5_filenames[0], 'r') as first_file:
             grid = GridImages(first_file, alignment_channel)
-            # no reason to use all cores yet, since we're IO bound?
-            num_processes = len(h5_filenames)
-            pool = multiprocessing.Pool(num_processes)
-            base_column_checker = functools.partial(check_column_for_alignment, cluster_strategy, rotation_adjustment, alignment_channel, snr, sequencing_chip, metadata['microns_per_pixel'], fia, int(side1))
-            # Retrieve the left and right end tiles information
-            left_end_tiles = dict(find_bounds(pool, h5_filenames, base_column_checker, grid.columns, sequencing_chip.left_side_tiles))
-            right_end_tiles = dict(find_bounds(pool, h5_filenames, base_column_checker, reversed(grid.columns), sequencing_chip.right_side_tiles))
-            pool.close()
-            pool.join()
+            base_column_checker = functools.partial(check_column_for_alignment, cluster_strategy, rotation_adjustment, alignment_channel, snr, sequencing_chip, metadata['microns_per_pixel'], alignment_tile_store, int(side1), pyramid_levels, fourier_mellin,
+                                                    single_precision)
+            # Retrieve the left and right end tiles information. Both sides are searched at the same time, with enough
+            # columns in flight to keep every worker busy.
+            columns_in_flight = max(1, calculate_process_count(process_limit) // (2 * len(h5_filenames)))
+            left_end_tiles, right_end_tiles = find_bounds(pool, h5_filenames, base_column_checker,
+                                                          [(grid.columns, sequencing_chip.left_side_tiles),
+                                                           (list(reversed(grid.columns)), sequencing_chip.right_side_tiles)],
+                                                          columns_in_flight)
             if left_end_tiles and right_end_tiles:
                 break
     # There are several parameters affecting the alignment outcomes, such as rotation angle, pixel size, flipping, and ports position. It could also be possible that the acquired images only cover part of either end tiles.
@@ -170,75 +478,77 @@ def build_end_tiles(h5_filenames, experiment_chip, left_end_tiles, default_left_
     return end_tiles
 
 
-def count_images(h5_filenames, channel):
-    image_count = 0
-    for h5_filename in h5_filenames:
-        with h5py.File(h5_filename, 'r') as h5:
-            grid = GridImages(h5, channel)
-            image_count += len(grid)
-    return image_count
-
-
-def calculate_process_count(image_count):
+def calculate_process_count(process_limit=0):
     # Leave at least two processors free so we don't totally hammer the server
     num_processes = max(multiprocessing.cpu_count() - 2, 1)
+    if process_limit > 0:
+        num_processes = min(process_limit, num_processes)
+    return num_processes
+
+
+def calculate_chunksize(image_count, num_processes):
     # we add 1 to the chunksize to ensure that at most one processor will have less than a full workload the entire time
     # we set the minimum to 32 to ensure that in small datasets, we have constant throughput
-    chunksize = min(32, int(math.ceil(float(image_count) / float(num_processes))) + 1)
-    return num_processes, chunksize
+    return min(32, int(math.ceil(float(image_count) / float(num_processes))) + 1)
+
 
+def load_aligned_stats_files(h5_filenames, alignment_channel, path_info):
+    alignment_ledger = load_ledger(path_info)
+    for h5_filename in h5_filenames:
+        base_name = os.path.splitext(h5_filename)[0]
+        for image_index, row, column in alignment_ledger.aligned_images(base_name, alignment_channel):
+            yield h5_filename, base_name, '{}_stats.txt'.format(image_index), row, column
 
-def extract_rc_info(stats_file):
-    match = stats_regex.match(stats_file)
-    if match:
-        return int(match.group('row')), int(match.group('column'))
-    raise ValueError("Invalid stats file: %s" % str(stats_file))
 
+def import_stats_files(h5_filenames, path_info):
+    """
+    Records the images that were aligned before there was an alignment ledger in it. Only the stats files of images that
+    the ledger doesn't have an alignment for are parsed, so this is quick after the first time.
 
-def load_aligned_stats_files(h5_filenames, alignment_channel, path_info):
+    """
+    if path_info.shared_run:
+        # the stats files are the ledger
+        return
+    alignment_ledger = load_ledger(path_info)
+    stats_files = ledger.StatsFiles(path_info.results_directory)
     for h5_filename in h5_filenames:
         base_name = os.path.splitext(h5_filename)[0]
-        for filename in os.listdir(os.path.join(path_info.results_directory, base_name)):
-            if filename.endswith('_stats.txt') and alignment_channel in filename:
-                try:
-                    row, column = extract_rc_info(filename)
-                except ValueError:
-                    log.warn("Invalid stats file: %s" % str(filename))
-                    continue
-                else:
-                    yield h5_filename, base_name, filename, row, column
-
-
-def process_data_image(cluster_strategy, path_info, all_tile_data, um_per_pixel, make_pdfs, channel,
-                       fastq_image_aligner, min_hits, (h5_filename, base_name, stats_filepath, row, column)):
+        alignments = [(base_name, image_index, channel, row, column, astats, None, None, None)
+                      for image_index, channel, row, column, astats
+                      in stats_files.alignments(base_name, skip=alignment_ledger.aligned_image_indexes(base_name))]
+        if alignments:
+            alignment_ledger.record_alignments(alignments)
+            log.info("Imported %d stats files of %s into the alignment ledger" % (len(alignments), base_name))
+
+
+def process_data_image(cluster_strategy, path_info, all_tile_store, um_per_pixel, make_pdfs, channel,
+                       alignment_tile_store, min_hits, refinement_iterations, binary_output, (h5_filename, base_name, stats_filepath, row, column)):
+    started = time.time()
     image = load_image(h5_filename, channel, row, column)
     alignment_stats_file_path = os.path.join(path_info.results_directory, base_name, stats_filepath)
     data_stats_file_path = os.path.join(path_info.results_directory, base_name, '{}_stats.txt'.format(image.index))
-    if alignment_is_complete(data_stats_file_path):
+    if alignment_is_complete(path_info, base_name, image.index):
         log.debug("Already aligned %s from %s" % (image.index, h5_filename))
-        del image
-        gc.collect()
         return
     sexcat_filepath = os.path.join(base_name, '%s.clusters.%s' % (image.index, cluster_strategy))
-    local_fia = deepcopy(fastq_image_aligner)
+    local_fia = load_aligner(alignment_tile_store, um_per_pixel)
     local_fia.set_image_data(image, um_per_pixel)
     local_fia.set_sexcat_from_file(sexcat_filepath, cluster_strategy)
     local_fia.alignment_from_alignment_file(alignment_stats_file_path)
     try:
-        local_fia.precision_align_only(min_hits)
+        local_fia.precision_align_only(min_hits, refinement_iterations)
     except (IndexError, ValueError):
         log.debug("Could not precision align %s" % image.index)
+        load_ledger(path_info).record_failure(base_name, image.index, channel, row, column, cluster_strategy,
+                                              started, time.time())
     else:
         log.debug("Processed data channel for %s" % image.index)
-        write_output(data_stats_file_path, image.index, base_name, local_fia, path_info, all_tile_data, make_pdfs, um_per_pixel)
-    finally:
-        del local_fia
-        del image
-    gc.collect()
+        write_output(data_stats_file_path, image, base_name, local_fia, path_info, all_tile_store, make_pdfs, um_per_pixel, binary_output,
+                     cluster_strategy, started)
 
 
 def load_image(h5_filename, channel, row, column):
-    with h5py.File(h5_filename) as h5:
+    with h5py.File(h5_filename, 'r') as h5:
         grid = GridImages(h5, channel)
         return grid.get(row, column)
 
@@ -254,20 +564,57 @@ def decide_default_tiles_and_columns(end_tiles):
     return best_tile, best_column
 
 
-def find_bounds(pool, h5_filenames, base_column_checker, columns, possible_tile_keys):
-    end_tiles = Manager().dict()
-    for column in columns:
-        column_checker = functools.partial(base_column_checker, end_tiles, column, possible_tile_keys)
-        pool.map_async(column_checker, h5_filenames).get(sys.maxint)
-        if end_tiles:
-            return end_tiles
-    return {}
+def find_bounds(pool, h5_filenames, base_column_checker, searches, columns_in_flight):
+    """
+    Finds the outermost column that aligns in each of the (columns, possible_tile_keys) searches, whose columns are
+    ordered from the edge of the chip inward. The next few columns of every search are checked speculatively while
+    waiting for the outer ones. Once a column aligns, the checks of the columns after it are cancelled.
 
+    Returns a {h5_filename: (hitting tile keys, column)} dictionary for each search, which is empty if nothing aligned.
 
-def check_column_for_alignment(cluster_strategy, rotation_adjustment, channel, snr, sequencing_chip, um_per_pixel, fia, side1,
-                               end_tiles, column, possible_tile_keys, h5_filename):
+    """
+    stop_directory = tempfile.mkdtemp(prefix='champ-end-tiles-')
+    stop_paths = [os.path.join(stop_directory, str(i)) for i in range(len(searches))]
+    remaining_columns = [iter(columns) for columns, _ in searches]
+    pending = [collections.deque() for _ in searches]
+    end_tiles = [None for _ in searches]
+
+    def check_next_column(i):
+        column = next(remaining_columns[i], None)
+        if column is not None:
+            pending[i].append([pool.apply_async(base_column_checker, (stop_paths[i], column, searches[i][1], h5_filename))
+                               for h5_filename in h5_filenames])
+
+    try:
+        for i in range(len(searches)):
+            for _ in range(columns_in_flight):
+                check_next_column(i)
+        while any(end_tiles[i] is None and pending[i] for i in range(len(searches))):
+            for i in range(len(searches)):
+                # the columns are only decided in order, since an outer column could still align
+                while end_tiles[i] is None and pending[i] and all(result.ready() for result in pending[i][0]):
+                    column_end_tiles = dict(result for result in (result.get() for result in pending[i].popleft()) if result is not None)
+                    if column_end_tiles:
+                        end_tiles[i] = column_end_tiles
+                        open(stop_paths[i], 'w').close()
+                    else:
+                        check_next_column(i)
+            time.sleep(END_TILE_POLL_INTERVAL)
+        # cancelled checks return right away, but they need the stop files until then
+        for column_results in itertools.chain(*pending):
+            for result in column_results:
+                result.wait()
+    finally:
+        shutil.rmtree(stop_directory, ignore_errors=True)
+    return [tiles or {} for tiles in end_tiles]
+
+
+def check_column_for_alignment(cluster_strategy, rotation_adjustment, channel, snr, sequencing_chip, um_per_pixel, alignment_tile_store, side1,
+                               pyramid_levels, fourier_mellin, single_precision, stop_path, column, possible_tile_keys, h5_filename):
+    # Returns (h5_filename, (hitting tile keys, column)) for the first image in the column that aligns, or None. Gives up
+    # as soon as a file exists at stop_path, which find_bounds uses to cancel the checks that are no longer needed.
     base_name = os.path.splitext(h5_filename)[0]
-    with h5py.File(h5_filename) as h5:
+    with h5py.File(h5_filename, 'r') as h5:
         grid = GridImages(h5, channel)
         # we assume odd numbers of rows, and good enough for now
         if grid.height > 2:
@@ -277,21 +624,21 @@ def check_column_for_alignment(cluster_strategy, rotation_adjustment, channel, s
             # just one or two rows, might as well try them all
             rows_to_check = tuple([i for i in range(grid.height)])
         for row in rows_to_check:
+            if os.path.exists(stop_path):
+                return
             image = grid.get(row, column)
             if image is None:
                 log.warn("Could not find an image for %s Row %d Column %d" % (base_name, row, column))
                 return
             log.debug("Aligning %s Row %d Column %d against PhiX" % (base_name, row, column))
-            fia = process_alignment_image(cluster_strategy, rotation_adjustment, snr, sequencing_chip, base_name, um_per_pixel, image, possible_tile_keys, deepcopy(fia), side1)
-            if fia.hitting_tiles:
+            image_fia = process_alignment_image(cluster_strategy, rotation_adjustment, snr, sequencing_chip, base_name, um_per_pixel, image, possible_tile_keys, load_aligner(alignment_tile_store, um_per_pixel), side1, pyramid_levels, fourier_mellin,
+                                                single_precision=single_precision)
+            if image_fia.hitting_tiles:
                 log.debug("%s aligned to at least one tile!" % image.index)
                 # because of the way we iterate through the images, if we find one that aligns,
                 # we can just stop because that gives us the outermost column of images and the
                 # outermost FastQ tile
-                end_tiles[h5_filename] = [tile.key for tile in fia.hitting_tiles], image.column
-                break
-    del fia
-    gc.collect()
+                return h5_filename, ([tile.key for tile in image_fia.hitting_tiles], image.column)
 
 
 def iterate_all_images(h5_filenames, end_tiles, channel, path_info):
@@ -300,7 +647,9 @@ def iterate_all_images(h5_filenames, end_tiles, channel, path_info):
     # to the image itself that allow files to be written in the correct place and such
     for h5_filename in h5_filenames:
         base_name = os.path.splitext(h5_filename)[0]
-        with h5py.File(h5_filename) as h5:
+        # images are only recorded as aligned in the ledger once their reads are written
+        aligned_images = set(image_index for image_index, _, _ in load_ledger(path_info).aligned_images(base_name, channel))
+        with h5py.File(h5_filename, 'r') as h5:
             grid = GridImages(h5, channel)
             min_column, max_column, tile_map = end_tiles[h5_filename]
             for column in range(min_column, max_column):
@@ -308,49 +657,47 @@ def iterate_all_images(h5_filenames, end_tiles, channel, path_info):
                     image = grid.get(row, column)
                     if image is None:
                         continue
-                    stats_path = os.path.join(path_info.results_directory, base_name,
-                                              '{}_stats.txt'.format(image.index))
-                    alignment_path = os.path.join(path_info.results_directory, base_name,
-                                                  '{}_all_read_rcs.txt'.format(image.index))
-                    already_aligned = alignment_is_complete(stats_path) and os.path.exists(alignment_path)
-                    if already_aligned:
+                    if image.index in aligned_images:
                         log.debug("Image already aligned/checkpointed: {}/{}".format(h5_filename, image.index))
                         continue
                     yield row, column, channel, h5_filename, tile_map[image.column], base_name
 
 
-def load_read_names(file_path):
-    if not file_path:
-        return {}
-    # reads a FastQ file with Illumina read names
-    with open(file_path) as f:
-        tiles = defaultdict(set)
-        for line in f:
-            try:
-                lane, tile = line.strip().rsplit(':', 4)[1:3]
-            except ValueError:
-                if line.strip():
-                    log.warn("Invalid line in read file: %s" % file_path)
-                    log.warn("The invalid line was: %s" % line)
-            else:
-                key = 'lane{0}tile{1}'.format(lane, tile)
-                tiles[key].add(line.strip())
-    del f
-    return {key: list(values) for key, values in tiles.items()}
+def load_aligner(tile_store, um_per_pixel):
+    # Each call attaches to the same shared reads, so this is cheap enough to do for every image
+    fia = fastqimagealigner.FastqImageAligner(um_per_pixel)
+    fia.load_tile_store(tile_store)
+    return fia
 
 
-def process_alignment_image(cluster_strategy, rotation_adjustment, snr, sequencing_chip, base_name, um_per_pixel, image, possible_tile_keys, fia, side1):
-    fia.set_image_data(image, um_per_pixel)
+def process_alignment_image(cluster_strategy, rotation_adjustment, snr, sequencing_chip, base_name, um_per_pixel, image, possible_tile_keys, fia, side1, pyramid_levels=0, fourier_mellin=False,
+                            early_exit_snr=None, likely_tile_count=0, noise_floor=None, single_precision=False, predicted_alignments=None,
+                            window_margin=None):
+    fia.set_image_data(image, um_per_pixel, single_precision)
     sexcat_fpath = os.path.join(base_name, '%s.clusters.%s' % (image.index, cluster_strategy))
     if not os.path.exists(sexcat_fpath):
         return fia
     fia.set_sexcat_from_file(sexcat_fpath, cluster_strategy)
-    # Execute the rough alignment method in the FastqImageAligner.py
-    fia.rough_align(side1,
-                    possible_tile_keys,
-                    sequencing_chip.rotation_estimate + rotation_adjustment,
-                    sequencing_chip.tile_width,
-                    snr_thresh=snr)
+    if predicted_alignments:
+        # Only search the offsets near where the tiles are expected to be
+        fia.rough_align_in_windows(side1,
+                                   predicted_alignments,
+                                   sequencing_chip.rotation_estimate + rotation_adjustment,
+                                   sequencing_chip.tile_width,
+                                   snr_thresh=snr,
+                                   margin=window_margin if window_margin is not None else fastqimagealigner.WINDOW_MARGIN)
+    else:
+        # Execute the rough alignment method in the FastqImageAligner.py
+        fia.rough_align(side1,
+                        possible_tile_keys,
+                        sequencing_chip.rotation_estimate + rotation_adjustment,
+                        sequencing_chip.tile_width,
+                        snr_thresh=snr,
+                        pyramid_levels=pyramid_levels,
+                        fourier_mellin=fourier_mellin,
+                        early_exit_snr=early_exit_snr,
+                        likely_tile_count=likely_tile_count,
+                        noise_floor=noise_floor)
     if fia.hitting_tiles:
         log.debug("Rough aligned %s with cluster strategy: %s" % (image.index, cluster_strategy))
         return fia
@@ -359,22 +706,15 @@ def process_alignment_image(cluster_strategy, rotation_adjustment, snr, sequenci
     return fia
 
 
-def load_existing_score(stats_file_path):
-    if os.path.isfile(stats_file_path):
-        with open(stats_file_path) as f:
-            try:
-                return stats.AlignmentStats().from_file(f).score
-            except (TypeError, ValueError):
-                return 0
-    return 0
-
-
-def write_output(stats_file_path, image_index, base_name, fastq_image_aligner, path_info, all_tile_data, make_pdfs, um_per_pixel):
+def write_output(stats_file_path, image, base_name, fastq_image_aligner, path_info, all_tile_store, make_pdfs, um_per_pixel,
+                 binary_output=False, cluster_strategy=None, started=None):
+    image_index = image.index
+    alignment_ledger = load_ledger(path_info)
     all_read_rcs_filepath = os.path.join(path_info.results_directory, base_name, '{}_all_read_rcs.txt'.format(image_index))
 
     # if we've already aligned this channel with a different strategy, the current alignment may or may not be better
     # here we load some data so we can make that comparison
-    existing_score = load_existing_score(stats_file_path)
+    existing_score = alignment_ledger.score(base_name, image_index)
 
     new_stats = fastq_image_aligner.alignment_stats
     if existing_score > 0:
@@ -388,10 +728,18 @@ def write_output(stats_file_path, image_index, base_name, fastq_image_aligner, p
 
     # save the corrected location of each read
     all_fastq_image_aligner = fastqimagealigner.FastqImageAligner(um_per_pixel)
-    all_fastq_image_aligner.all_reads_fic_from_aligned_fic(fastq_image_aligner, all_tile_data)
-    with open(all_read_rcs_filepath, 'w') as f:
-        for line in all_fastq_image_aligner.read_names_rcs:
-            f.write(line)
+    all_fastq_image_aligner.all_reads_fic_from_aligned_fic(fastq_image_aligner, all_tile_store)
+    if binary_output:
+        # the ids refer to the tile index of all_read_names.txt, see readrcs
+        read_ids, rcs = all_fastq_image_aligner.read_ids_rcs
+        readrcs.write(readrcs.results_path(path_info.results_directory, base_name), image_index, read_ids, rcs, all_tile_store)
+    else:
+        with open(all_read_rcs_filepath, 'w') as f:
+            for line in all_fastq_image_aligner.read_names_rcs:
+                f.write(line)
+    # the image only counts as aligned once all of its output is written
+    alignment_ledger.record_alignment(base_name, image_index, image.channel, image.row, image.column, new_stats, cluster_strategy,
+                                      started, time.time())
 
     # save some diagnostic PDFs that give a nice visualization of the alignment
     if make_pdfs:
@@ -401,6 +749,4 @@ def write_output(stats_file_path, image_index, base_name, fastq_image_aligner, p
         ax = plotting.plot_hit_hists(fastq_image_aligner)
         ax.figure.savefig(os.path.join(path_info.figure_directory, base_name, '{}_hit_hists.pdf'.format(image_index)))
         plt.close()
-    del all_fastq_image_aligner
-    del fastq_image_aligner
     return True
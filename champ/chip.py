@@ -1,7 +1,20 @@
-from collections import defaultdict
+from collections import Counter, defaultdict
 import itertools
 
 # This file contains the chip-related information
+# Tiles that at least this fraction of the aligned images in a column hit are expected to align in the rest of it
+LIKELY_TILE_FRACTION = 0.25
+
+
+def _tile_number(tile_key):
+    return tile_key.rsplit('tile', 1)[1]
+
+
+def _on_side(tile_key, side):
+    # The key of the tile in the same position on the given side of the chip, e.g. lane1tile1103 for lane1tile2103
+    prefix, number = tile_key.rsplit('tile', 1)
+    return '%stile%s%s' % (prefix, side, number[1:])
+
 
 class BaseChip(object):
     def __init__(self, tile_count):
@@ -42,6 +55,28 @@ class BaseChip(object):
                 tile_map[tile_map_column].append(self._format_tile_number(expected - 1))
         return tile_map
 
+    def rank_expected_tiles(self, expected_tiles, hitting_tile_counts, image_count):
+        # Refines the expected tiles of a column (see expected_tile_map) with the tiles that the image_count aligned images
+        # in that column have actually hit. Returns the tiles that are likely to align (usually one, or two for columns
+        # that straddle tiles, or none if nothing in the column is aligned yet) and all of the other candidates, from most
+        # to least likely.
+        if expected_tiles:
+            # With side 1 images the hits are side 1 tiles while the expected tiles are on side 2, so hits are counted
+            # for the tile in the same position on the side of the expected tiles
+            side = _tile_number(expected_tiles[0])[0]
+            side_counts = Counter()
+            for tile, count in hitting_tile_counts.items():
+                side_counts[_on_side(tile, side)] += count
+            hitting_tile_counts = side_counts
+
+        def likelihood(tile):
+            # Ties keep the order of the expected tiles, which has the predicted tile first
+            return -hitting_tile_counts.get(tile, 0), expected_tiles.index(tile) if tile in expected_tiles else len(expected_tiles)
+
+        candidates = sorted(set(expected_tiles) | set(hitting_tile_counts), key=likelihood)
+        likely_tiles = [tile for tile in candidates if image_count and hitting_tile_counts.get(tile, 0) >= LIKELY_TILE_FRACTION * image_count]
+        return likely_tiles, [tile for tile in candidates if tile not in likely_tiles]
+
     def _format_tile_number(self, tile):
         return 'lane{lane}tile{tile}'.format(lane=self._lane, tile=tile)
 
@@ -1,4 +1,5 @@
 import numpy as np
+from scipy.spatial import cKDTree
 
 
 class ClusterPoint(object):
@@ -30,6 +31,14 @@ class Clusters(object):
                 continue
             self.points.append(Point(line))
         self.point_rcs = np.array([(pt.r, pt.c) for pt in self.points])
+        self._tree = None
+
+    @property
+    def tree(self):
+        # The catalog doesn't change while an image is being aligned, so the tree is only built once
+        if self._tree is None:
+            self._tree = cKDTree(self.point_rcs)
+        return self._tree
 
     def rs(self):
         return np.array([pt.r for pt in self.points])
@@ -30,6 +30,11 @@ class CommandLineArguments(object):
     def alternate_perfect_target_reads_filename(self):
         return self._arguments['--alternate-perfect-reads'] or False
 
+    @property
+    def binary_output(self):
+        # write the aligned reads of each HDF5 file to one HDF5 file of read ids and locations instead of text files
+        return self._arguments['--binary-output']
+
     @property
     def chip(self):
         chip = load(self._arguments['--chip'] or 'miseq')
@@ -65,6 +70,11 @@ class CommandLineArguments(object):
     def fiducial_only(self):
         return self._arguments['--fiducial-only']
 
+    @property
+    def fourier_mellin(self):
+        # estimate rotation and scale of each image before rough alignment
+        return self._arguments['--fourier-mellin']
+
     @property
     def image_directory(self):
         return self._arguments['IMAGE_DIRECTORY']
@@ -86,6 +96,11 @@ class CommandLineArguments(object):
     def log_p_file_path(self):
         return self._arguments['--log-p-file']
 
+    @property
+    def learn_tile_map(self):
+        # try the tiles that other images in the same column aligned to before the other candidates
+        return self._arguments['--learn-tile-map']
+
     @property
     def make_pdfs(self):
         return self._arguments['--make-pdfs']
@@ -98,6 +113,12 @@ class CommandLineArguments(object):
     def max_len(self):
         return int(self._arguments['--max-len'] or 50)
 
+    @property
+    def max_tasks_per_worker(self):
+        # 0 indicates that workers are never replaced
+        max_tasks_per_worker = self._arguments['--max-tasks-per-worker']
+        return int(max_tasks_per_worker) if max_tasks_per_worker is not None else None
+
     @property
     def microns_per_pixel(self):
         return float(self._arguments['--microns-per-pixel'] or 0.2666666666666666666)
@@ -141,15 +162,46 @@ class CommandLineArguments(object):
     def ports_on_right(self):
         return self._arguments['--ports-on-right']
 
+    @property
+    def spectrum_cache_mb(self):
+        # the memory that each worker may use to cache tile spectra, by default a share of the available memory
+        spectrum_cache_mb = self._arguments['--spectrum-cache-mb']
+        return int(spectrum_cache_mb) if spectrum_cache_mb is not None else None
+
     @property
     def process_limit(self):
         # 0 indicates unlimited
         return int(self._arguments['--process-limit'] or 0)
 
+    @property
+    def neighbor_priors(self):
+        # predict alignments from neighboring images before trying a rough alignment
+        return self._arguments['--neighbor-priors']
+
+    @property
+    def noise_floor(self):
+        # estimate the control correlation once per HDF5 file instead of measuring it for every image
+        return self._arguments['--noise-floor']
+
+    @property
+    def pyramid_levels(self):
+        # 0 disables coarse-to-fine rough alignment
+        return int(self._arguments['--pyramid-levels'] or 0)
+
+    @property
+    def refinement_iterations(self):
+        # 0 disables iterative refinement of the precision alignment
+        return int(self._arguments['--refinement-iterations'] or 0)
+
     @property
     def rotation_adjustment(self):
         return float(self._arguments['--rotation-adjustment'] or 0.0)
 
+    @property
+    def single_precision(self):
+        # do the rough alignment FFTs with complex64 spectra
+        return self._arguments['--single-precision']
+
     @property
     def snr(self):
         # 1.4 is a decent and relatively stringent default, though we used 1.2 for a long time with no problem
@@ -159,21 +211,38 @@ class CommandLineArguments(object):
     def target_sequence_file(self):
         return self._arguments['--target-sequence-file'] or False
     
+    @property
+    def stage_model(self):
+        # fit a model of the stage positions and use it to predict alignments
+        return self._arguments['--stage-model']
+
+    @property
+    def run_name(self):
+        # champ align processes with the same run name split up the images of an experiment between them
+        return self._arguments['--run-name']
+
     @property
     def side1(self):
         return self._arguments['--side1'] or False
 
+    @property
+    def window_margin(self):
+        # how far around predicted alignments to search, by default fastqimagealigner.WINDOW_MARGIN
+        window_margin = self._arguments['--window-margin']
+        return int(window_margin) if window_margin is not None else None
+
 
 class PathInfo(object):
     """ Parses user-provided alignment parameters and provides a default in case no value was given. """
     def __init__(self, image_directory, mapped_reads, perfect_target_name, alternate_fiducial_reads=None,
-                 alternate_perfect_reads_filename=None, alternate_good_reads_filename=None):
+                 alternate_perfect_reads_filename=None, alternate_good_reads_filename=None, run_name=None):
         self._alternate_fiducial_reads = alternate_fiducial_reads
         self._alternate_good_reads_filename = alternate_good_reads_filename
         self._alternate_perfect_reads_filename = alternate_perfect_reads_filename
         self._image_directory = image_directory
         self._mapped_reads = mapped_reads
         self._perfect_target_name = perfect_target_name
+        self._run_name = run_name
 
     @property
     def aligning_read_names_filepath(self):
@@ -185,6 +254,11 @@ class PathInfo(object):
     def all_read_names_filepath(self):
         return os.path.join(self._mapped_reads, 'all_read_names.txt')
 
+    @property
+    def shared_run(self):
+        # other machines might be working on the same results (see lease.WorkLeases)
+        return bool(self._run_name)
+
     @property
     def figure_directory(self):
         return os.path.join(self._image_directory, 'figs')
@@ -1,8 +1,9 @@
+import functools
 import logging
 import os
-from champ import align, initialize, error, projectinfo, chip, fastqimagealigner, convert, fits
+import sqlite3
+from champ import align, initialize, error, projectinfo, chip, convert, fits, stagemodel, tilestore, lease, ledger
 from champ.config import PathInfo
-import gc
 
 log = logging.getLogger(__name__)
 cluster_strategies = ('se',)
@@ -35,78 +36,122 @@ def main(clargs):
                          metadata['perfect_target_name'],
                          metadata['alternate_fiducial_reads'],
                          metadata['alternate_perfect_target_reads_filename'],
-                         metadata['alternate_good_target_reads_filename'])
+                         metadata['alternate_good_target_reads_filename'],
+                         clargs.run_name)
     # Ensure we have the directories where output will be written
     align.make_output_directories(h5_filenames, path_info)
+    # Images that were aligned before the alignment ledger existed are added to it
+    try:
+        align.import_stats_files(h5_filenames, path_info)
+    except sqlite3.DatabaseError as e:
+        error.fail("The alignment ledger in %s can't be read (%s). Delete %s and it will be rebuilt from the stats files."
+                   % (path_info.results_directory, e, ledger.FILENAME))
 
     log.debug("Loading tile data.")
     sequencing_chip = chip.load(metadata['chip_type'])(metadata['ports_on_right'])
 
-    alignment_tile_data = align.load_read_names(path_info.aligning_read_names_filepath)
-    perfect_tile_data = align.load_read_names(path_info.perfect_read_names)
-    on_target_tile_data = align.load_read_names(path_info.on_target_read_names)
-    all_tile_data = align.load_read_names(path_info.all_read_names_filepath)
+    # The reads are kept in shared memory, so that worker processes don't each need their own copy
+    tile_stores = [load_tile_store(path, name) for path, name in ((path_info.aligning_read_names_filepath, 'alignment'),
+                                                                  (path_info.perfect_read_names, 'perfect-target'),
+                                                                  (path_info.on_target_read_names, 'on-target'),
+                                                                  (path_info.all_read_names_filepath, 'all'))]
     log.debug("Tile data loaded.")
-
-    # We use one process per concentration. We could theoretically speed this up since our machine
-    # has significantly more cores than the typical number of concentration points, but since it
-    # usually finds a result in the first image or two, it's not going to deliver any practical benefits
-    log.debug("Loading FastQImageAligner")
-    fia = fastqimagealigner.FastqImageAligner(clargs.microns_per_pixel)
-    fia.load_reads(alignment_tile_data)
-    log.debug("Loaded %s points" % sum([len(v) for v in alignment_tile_data.values()]))
-    log.debug("FastQImageAligner loaded.")
+    if clargs.binary_output and tile_stores[-1].temporary:
+        # the read ids in the output would refer to reads that are gone after this run
+        for tile_store in tile_stores:
+            tile_store.close()
+        error.fail("--binary-output needs an index of %s, which could not be written." % path_info.all_read_names_filepath)
+    # One pool does all of the work, so that workers aren't started again for every file and phase
+    pool = align.create_pool(clargs.process_limit, clargs.spectrum_cache_mb, clargs.max_tasks_per_worker)
+    # Other champ processes that were started with the same run name split the images with this one
+    leases = lease.load(clargs.image_directory, clargs.run_name)
+    try:
+        align_all(clargs, metadata, cache, h5_filenames, path_info, sequencing_chip, pool, leases, *tile_stores)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+        leases.close()
+        for tile_store in tile_stores:
+            tile_store.close()
+
+
+def load_tile_store(read_names_filepath, name):
+    # The tile index is built the first time, and later runs just attach to it
+    try:
+        return tilestore.load_index(read_names_filepath)
+    except (IOError, OSError) as e:
+        # probably a read names directory that we can't write to, so we keep the reads in memory for this run only
+        log.warn("Could not index %s (%s), parsing the read names instead." % (read_names_filepath, e))
+        return tilestore.create(tilestore.parse_read_names(read_names_filepath), name)
+
+
+def align_all(clargs, metadata, cache, h5_filenames, path_info, sequencing_chip, pool, leases, alignment_tile_store, perfect_tile_store,
+              on_target_tile_store, all_tile_store):
+    log.debug("Loaded %s points" % alignment_tile_store.read_count)
 
     if 'end_tiles' not in cache:
-        end_tiles = align.get_end_tiles(cluster_strategies, clargs.rotation_adjustment, h5_filenames, metadata['alignment_channel'], clargs.snr, metadata, sequencing_chip, fia, clargs.side1)
-        cache['end_tiles'] = end_tiles
-        initialize.save_cache(clargs.image_directory, cache)
+        # In a shared run, one process finds the end tiles while the others wait for it to save them
+        for claimed in leases.rounds(['end_tiles']):
+            for key in claimed:
+                cache['end_tiles'] = align.get_end_tiles(cluster_strategies, clargs.rotation_adjustment, h5_filenames, metadata['alignment_channel'], clargs.snr, metadata, sequencing_chip, alignment_tile_store, clargs.side1, clargs.pyramid_levels, clargs.fourier_mellin,
+                                                         clargs.single_precision, pool, clargs.process_limit)
+                initialize.save_cache(clargs.image_directory, cache)
+                leases.release(key)
+        if 'end_tiles' not in cache:
+            cache['end_tiles'] = initialize.load_cache(clargs.image_directory)['end_tiles']
+        end_tiles = cache['end_tiles']
     else:
         log.debug("End tiles already calculated.")
         end_tiles = cache['end_tiles']
-    gc.collect()
+
+    # The stage model and noise floors are kept in the run cache, so that later runs don't have to estimate them again
+    stage_model = stagemodel.StageModel.from_dict(cache['stage_model']) if cache.get('stage_model') else None
+    noise_floors = cache.setdefault('noise_floors', {}) if clargs.noise_floor else None
+
+    # Attempt to precision align protein channels using the phix channel alignment as a starting point. The protein
+    # channels of each image are aligned as soon as its phix alignment is done, while the other phix images are aligned.
+    data_channel_combos, data_processors = [], []
+    if not clargs.fiducial_only:
+        for channel_name in load_protein_channels(clargs.image_directory, metadata):
+            # Not all experiments have "on target" or "perfect target" reads - that only applies to CRISPR systems
+            # (at the time of this writing anyway)
+            for cluster_strategy in cluster_strategies:
+                channel_processors = []
+                for combo_suffix, tile_store in (("_on_target", on_target_tile_store), ("_perfect_target", perfect_tile_store)):
+                    channel_combo = channel_name + combo_suffix
+                    if tile_store and channel_combo not in cache['protein_channels_aligned']:
+                        log.info("Aligning %s" % channel_combo)
+                        data_channel_combos.append(channel_combo)
+                        channel_processors.append(align.data_channel_processor(cluster_strategy, channel_name, path_info, tile_store, all_tile_store, clargs))
+                if channel_processors:
+                    # both combos write the same files, so the second one only does the images that the first one couldn't
+                    data_processors.append(functools.partial(align.run_in_order, channel_processors))
 
     if not cache['phix_aligned']:
         for cluster_strategy in cluster_strategies:
-            align.run(cluster_strategy, clargs.rotation_adjustment, h5_filenames, path_info, clargs.snr, clargs.min_hits, fia, end_tiles, metadata['alignment_channel'],
-                      all_tile_data, metadata, clargs.make_pdfs, sequencing_chip, clargs.process_limit, clargs.side1)
+            stage_model = align.run(cluster_strategy, clargs.rotation_adjustment, h5_filenames, path_info, clargs.snr, clargs.min_hits, alignment_tile_store, end_tiles, metadata['alignment_channel'],
+                                    all_tile_store, metadata, clargs.make_pdfs, sequencing_chip, pool, clargs.process_limit, clargs.side1, clargs.pyramid_levels, clargs.fourier_mellin,
+                                    clargs.refinement_iterations, clargs.neighbor_priors, clargs.stage_model, stage_model, clargs.learn_tile_map,
+                                    noise_floors, clargs.single_precision, clargs.window_margin, clargs.binary_output, data_processors, leases)
+            if stage_model is not None:
+                cache['stage_model'] = stage_model.to_dict()
             cache['phix_aligned'] = True
             initialize.save_cache(clargs.image_directory, cache)
-        else:
-            log.debug("Phix already aligned.")
+    else:
+        log.debug("Phix already aligned.")
+        if data_processors:
+            align.run_data_channels(h5_filenames, data_processors, metadata, path_info, pool, clargs.process_limit, leases)
+    cache['protein_channels_aligned'].extend(data_channel_combos)
+    initialize.save_cache(clargs.image_directory, cache)
 
-    if clargs.fiducial_only:
-        # the user doesn't want us to align the protein channels
-        exit(0)
 
-    gc.collect()
-    protein_channels = [channel for channel in projectinfo.load_channels(clargs.image_directory) if channel != metadata['alignment_channel']]
+def load_protein_channels(image_directory, metadata):
+    protein_channels = [channel for channel in projectinfo.load_channels(image_directory) if channel != metadata['alignment_channel']]
     if protein_channels:
         log.debug("Protein channels found: %s" % ", ".join(protein_channels))
     else:
         # protein is in phix channel, hopefully?
         log.warn("No protein channels detected. Assuming protein is in phiX channel: %s" % [metadata['alignment_channel']])
         protein_channels = [metadata['alignment_channel']]
-
-    for channel_name in protein_channels:
-        # Attempt to precision align protein channels using the phix channel alignment as a starting point.
-        # Not all experiments have "on target" or "perfect target" reads - that only applies to CRISPR systems
-        # (at the time of this writing anyway)
-        for cluster_strategy in cluster_strategies:
-            gc.collect()
-            if on_target_tile_data:
-                channel_combo = channel_name + "_on_target"
-                combo_align(cluster_strategy, h5_filenames, channel_combo, channel_name, path_info, on_target_tile_data, all_tile_data, metadata, cache, clargs)
-            gc.collect()
-            if perfect_tile_data:
-                channel_combo = channel_name + "_perfect_target"
-                combo_align(cluster_strategy, h5_filenames, channel_combo, channel_name, path_info, perfect_tile_data, all_tile_data, metadata, cache, clargs)
-            gc.collect()
-
-
-def combo_align(cluster_strategy, h5_filenames, channel_combo, channel_name, path_info, alignment_tile_data, all_tile_data, metadata, cache, clargs):
-    log.info("Aligning %s" % channel_combo)
-    if channel_combo not in cache['protein_channels_aligned']:
-        align.run_data_channel(cluster_strategy, h5_filenames, channel_name, path_info, alignment_tile_data, all_tile_data, metadata, clargs, clargs.process_limit)
-        cache['protein_channels_aligned'].append(channel_combo)
-        initialize.save_cache(clargs.image_directory, cache)
+    return protein_channels
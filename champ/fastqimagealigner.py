@@ -1,14 +1,22 @@
 import logging
 import time
-from copy import deepcopy
 from itertools import izip
 import numpy as np
-from champ import stats, clusters
-from fastqtilercs import FastqTileRCs
+from champ import stats, clusters, fastqtilercs, misc
+from fastqtilercs import FastqTileRCs, FastqTileReads
 from imagedata import ImageData
-from scipy.spatial import KDTree
+from scipy.spatial import cKDTree
 
 log = logging.getLogger(__name__)
+# Binning used to locate the image in the tile before estimating rotation and scale
+FOURIER_MELLIN_BINNING = 4
+# Fourier-Mellin estimates larger than these are assumed to be wrong and are ignored
+MAX_FOURIER_MELLIN_ROTATION = 10.0  # degrees
+MAX_FOURIER_MELLIN_SCALE_CHANGE = 0.1
+# Iterative refinement of the precision alignment stops once no read moves further than this
+ICP_TOLERANCE = 0.01  # pixels
+# How far a windowed rough alignment searches around the predicted position of a tile
+WINDOW_MARGIN = 100  # pixels
 
 
 class FastqImageAligner(object):
@@ -28,28 +36,38 @@ class FastqImageAligner(object):
         self.image_data = None
         self.fq_w = 935  # um
         self.control_corr = 0
-        self.non_mutual_hits = set()
-        self.mutual_hits = set()
-        self.bad_mutual_hits = set()
-        self.good_mutual_hits = set()
-        self.exclusive_hits = set()
+        self.non_mutual_hits = np.zeros((0, 2), dtype=np.int)
+        self.mutual_hits = np.zeros((0, 2), dtype=np.int)
+        self.bad_mutual_hits = np.zeros((0, 2), dtype=np.int)
+        self.good_mutual_hits = np.zeros((0, 2), dtype=np.int)
+        self.exclusive_hits = np.zeros((0, 2), dtype=np.int)
         self.hitting_tiles = []
+        self.converged_tiles = []
+        # set when the tiles were only searched for near a predicted alignment
+        self.predicted = False
 
     def load_reads(self, tile_data, valid_keys=None):
         # Here we load phiX reads from the mapping result files.
         # We would like to organize the reads by their tiles. 
         for tile_key, read_names in tile_data.items():
             if valid_keys is None or tile_key in valid_keys:
-                self.fastq_tiles[tile_key] = FastqTileRCs(tile_key, read_names, self.microns_per_pixel)
+                self.fastq_tiles[tile_key] = FastqTileRCs(FastqTileReads(tile_key, read_names), self.microns_per_pixel)
+
+    def load_tile_store(self, tile_store, valid_keys=None):
+        # Same as load_reads, but the reads are attached from a tilestore.TileStore that is shared between processes.
+        for tile_key in tile_store.keys:
+            if valid_keys is None or tile_key in valid_keys:
+                self.fastq_tiles[tile_key] = FastqTileRCs(tile_store.tile_reads(tile_key), self.microns_per_pixel)
 
     @property
     def fastq_tiles_list(self):
         for _, tile in sorted(self.fastq_tiles.items()):
             yield tile
 
-    def all_reads_fic_from_aligned_fic(self, other_fic, all_reads):
-        self.load_reads(all_reads, valid_keys=[tile.key for tile in other_fic.hitting_tiles])
-        self.image_data = deepcopy(other_fic.image_data)
+    def all_reads_fic_from_aligned_fic(self, other_fic, all_tile_store):
+        self.load_tile_store(all_tile_store, valid_keys=[tile.key for tile in other_fic.hitting_tiles])
+        # the image is only read from here, so there's no need for a copy
+        self.image_data = other_fic.image_data
         self.fq_w = other_fic.fq_w
         self.set_fastq_tile_mappings()
         self.set_all_fastq_image_data()
@@ -60,7 +78,8 @@ class FastqImageAligner(object):
             try:
                 tile.set_aligned_rcs_given_transform(other_tile.scale,
                                                      other_tile.rotation,
-                                                     other_tile.offset)
+                                                     other_tile.offset,
+                                                     self.image_data.image.shape)
             except AttributeError:
                 # I'm not sure why this is happening - tiles aren't getting aligned?
                 # We will make sure tiles are aligned before writing results to disk
@@ -77,18 +96,23 @@ class FastqImageAligner(object):
         tile.set_aligned_rcs_given_transform(scale, rotation, rc_offset)
 
     def alignment_from_alignment_file(self, path):
-        self.hitting_tiles = []
         with open(path) as f:
             astats = stats.AlignmentStats().from_file(f)
-        for tile_key, scaling, tile_width, rotation, rc_offset, _ in astats:
+        self.set_tile_alignments(astats)
+
+    def set_tile_alignments(self, alignments):
+        # Takes (tile_key, scaling, tile_width, rotation, rc_offset, ...) tuples, like the ones an AlignmentStats yields
+        self.hitting_tiles = []
+        for alignment in alignments:
+            tile_key, scaling, tile_width, rotation, rc_offset = alignment[:5]
             self.set_tile_alignment(tile_key, scaling, tile_width, rotation, rc_offset)
 
     def set_sexcat_from_file(self, fpath, cluster_strategy):
         with open(fpath) as f:
             self.clusters = clusters.Clusters(f, cluster_strategy)
 
-    def set_image_data(self, image, um_per_pixel):
-        self.image_data = ImageData(image.index, um_per_pixel, image)
+    def set_image_data(self, image, um_per_pixel, single_precision=False):
+        self.image_data = ImageData(image.index, um_per_pixel, image, single_precision)
 
     def set_all_fastq_image_data(self):
         for key, tile in self.fastq_tiles.items():
@@ -112,10 +136,9 @@ class FastqImageAligner(object):
         assert self.image_data is not None, 'No image data loaded.'
         assert self.fastq_tiles != {}, 'No fastq data loaded.'
 
-        all_data = np.concatenate([tile.rcs for key, tile in self.fastq_tiles.items()])
-
-        x_min, y_min = all_data.min(axis=0)
-        x_max, y_max = all_data.max(axis=0)
+        reads = [tile.reads for tile in self.fastq_tiles.values() if len(tile.rcs)]
+        x_min, y_min = np.array([r.rcs_min for r in reads]).min(axis=0)
+        x_max, y_max = np.array([r.rcs_max for r in reads]).max(axis=0)
 
         self.fq_im_offset = np.array([-x_min, -y_min])
         # The scaling factor to transform from FASTQ coordinate system to microscope imaging coordinate system is computed by,
@@ -124,7 +147,7 @@ class FastqImageAligner(object):
         self.fq_im_scaled_maxes = self.fq_im_scale * np.array([x_max-x_min, y_max-y_min])
         self.fq_im_scaled_dims = (self.fq_im_scaled_maxes + [1, 1]).astype(np.int)
 
-    def find_hitting_tiles(self, side1, possible_tile_keys, snr_thresh=1.2):
+    def select_rough_alignment_tiles(self, side1, possible_tile_keys):
         # Here we include the "side1" argument to align phiX images to the tiles with tile number starting with "1"
         # To reduce the computational workload, in the original CHAMP program published in the Cell paper by Jung et al., the program can only align to the tiles starting with "2". 
         if side1:
@@ -146,45 +169,161 @@ class FastqImageAligner(object):
         impossible_tiles.sort(key=lambda tile: -len(tile.read_names))
         # Two control tiles having more reads are selected.
         control_tiles = impossible_tiles[:2]
+        return possible_tiles, control_tiles
+
+    def control_correlation(self, side1, possible_tile_keys, rotation_est, fq_w_est=927):
+        # Only measures the noise level that rough_align would compare the possible tiles against
+        self.map_fastq_tiles(rotation_est, fq_w_est)
+        _, control_tiles = self.select_rough_alignment_tiles(side1, possible_tile_keys)
+        self.image_data.set_fft(self.fq_im_scaled_dims)
+        return self.measure_control_correlation(control_tiles)
+
+    def measure_control_correlation(self, control_tiles):
+        return max([0] + [corr for corr, _ in fastqtilercs.fft_align_tiles_with_im(control_tiles, self.image_data)])
+
+    def find_hitting_tiles(self, side1, possible_tile_keys, snr_thresh=1.2, early_exit_snr=None, likely_tile_count=0, noise_floor=None):
+        possible_tiles, control_tiles = self.select_rough_alignment_tiles(side1, possible_tile_keys)
         # To compute the cross-correlation between FASTQ and the TIFF image, the program perform FFT on TIFF images.
         self.image_data.set_fft(self.fq_im_scaled_dims)
         self.control_corr = 0
-
-        
-        # Here we would like to link the tile number to its key so that we can print it later.
-        tile_num = {}
-        key_to_use = floor_possible_tile_keys if side1 else possible_tile_keys
-        for key in keys_to_use:
-            if self.fastq_tiles.get(key) in possible_tiles:
-                tile_num[self.fastq_tiles.get(key)] = key
-
-        for control_tile in control_tiles:
+        self.hitting_tiles = []
+        # With a noise_floor (the lowest, typical and highest control correlations of a sample of images, see
+        # align.estimate_noise_floor) the control tiles are only correlated if the best tile's correlation is close enough to
+        # the threshold that the noise level of this particular image could decide whether the image aligns. Other tiles
+        # that are that close (usually neighbors of the best one) are classified against the typical noise level.
+        if noise_floor is not None:
+            low_corr, self.control_corr, high_corr = noise_floor
+        correlated_tiles, tile_correlations = [], []
+        # The possible tiles can be ordered from most to least likely. The first likely_tile_count of them are tried first, and
+        # the others are only tried if none of those hit. With early_exit_snr, the others are correlated one at a time, and we
+        # stop as soon as one of them has an SNR above it.
+        if early_exit_snr is None:
+            batches = [possible_tiles[:likely_tile_count], possible_tiles[likely_tile_count:]]
+        else:
+            batches = [possible_tiles[:likely_tile_count]] + [[tile] for tile in possible_tiles[likely_tile_count:]]
+        largest_batch = max(len(batch) for batch in batches) + (len(control_tiles) if noise_floor is None else 0)
+        log.debug('FFT buffers are {}x{} {}, about {:.1f} MB for {} tiles'.format(
+            self.image_data.fft_shape[0], self.image_data.fft_shape[1], np.dtype(self.image_data.fft_dtype).name,
+            fastqtilercs.correlation_nbytes(largest_batch, self.image_data) / 1024.0 ** 2, largest_batch))
+        for batch_index, batch in enumerate(batches):
             ### ----------------------
-            # Here we perform FFT of control tiles and compute the cross-correlation value between TIFF images and the FASTQ tiles after FFT.
-            # The maximum correlation value is set as a control_corr. This serves as a "noise" level for the alignment.
-            # The "fft_align_with_im" method is in "fastqtilercs.py"
+            # Here we perform FFT of control tiles and possible tiles and compute the cross-correlation value between TIFF images and the FASTQ tiles after FFT.
+            # The tiles of a batch are correlated together, see "fft_align_tiles_with_im" in "fastqtilercs.py".
+            # The maximum correlation value of the control tiles is set as a control_corr. This serves as a "noise" level for the alignment.
             ### ----------------------
-            corr, _ = control_tile.fft_align_with_im(self.image_data)
-            if corr > self.control_corr:
-                self.control_corr = corr
-        del control_tiles
-        self.hitting_tiles = []
-        for tile in possible_tiles:
+            if batch_index == 0 and noise_floor is None:
+                correlations = fastqtilercs.fft_align_tiles_with_im(control_tiles + batch, self.image_data)
+                for corr, _ in correlations[:len(control_tiles)]:
+                    if corr > self.control_corr:
+                        self.control_corr = corr
+                correlations = correlations[len(control_tiles):]
+            else:
+                correlations = fastqtilercs.fft_align_tiles_with_im(batch, self.image_data)
+            correlated_tiles, tile_correlations = correlated_tiles + batch, tile_correlations + correlations
+            best_corr = max([0] + [corr for corr, _ in tile_correlations])
+            if noise_floor is not None and snr_thresh * low_corr < best_corr <= snr_thresh * high_corr:
+                log.debug('Best correlation is close to the threshold, measuring the control correlation of this image')
+                self.control_corr = self.measure_control_correlation(control_tiles)
+                noise_floor = None
+                # the tiles that were already classified against the noise floor get classified again
+                self.hitting_tiles = []
+                batch, correlations = correlated_tiles, tile_correlations
+            self.classify_rough_alignments(batch, correlations, snr_thresh)
+            if batch_index == 0 and likely_tile_count and self.hitting_tiles:
+                break
+            if early_exit_snr is not None and any(tile.snr > early_exit_snr for tile in self.hitting_tiles):
+                log.debug('Stopping rough alignment early, tile {} has an SNR above {}'.format(self.hitting_tiles[-1].key, early_exit_snr))
+                break
+
+    def classify_rough_alignments(self, possible_tiles, correlations, snr_thresh):
+        for tile, (max_corr, align_tr) in zip(possible_tiles, correlations):
             ### ----------------------
             # Here we compute the cross-correlation values between TIFF images and possible tiles after FFT to serve as a "signal".
             # The maximum correlation value is set as "max_corr". The user-defined SNR is serve as a criteria to evaluate if the alignment is success or not.
             # If the max_corr passes the product of SNR and the control_corr, then it is considered as a successful rough alignment.
             # The tile number will then be documented as a hitting tile.
             ### ----------------------
-            
-            max_corr, align_tr = tile.fft_align_with_im(self.image_data)
             if max_corr > snr_thresh * self.control_corr:
                 tile.set_aligned_rcs(align_tr)
                 tile.snr = max_corr / self.control_corr
                 self.hitting_tiles.append(tile)
 
             # Display the in-process alignment information.
-            log.debug('tile# = {}, SNR = {}, control_corr = {}, max_corr = {}'.format(tile_num[tile], round(max_corr/self.control_corr, 2), round(self.control_corr, 2), round(max_corr, 2)))
+            log.debug('tile# = {}, SNR = {}, control_corr = {}, max_corr = {}'.format(tile.key, round(max_corr/self.control_corr, 2), round(self.control_corr, 2), round(max_corr, 2)))
+
+    def find_hitting_tiles_pyramid(self, side1, possible_tile_keys, pyramid_levels, snr_thresh=1.2):
+        ### ----------------------
+        # Coarse-to-fine version of find_hitting_tiles. The image and the tile pseudo images are binned by 2^pyramid_levels
+        # and correlated with FFTs that are (2^pyramid_levels)^2 times smaller. The peak of each tile is then refined one
+        # level at a time by evaluating the correlation in a small window around it (see FastqTileRCs.refine_alignment).
+        # Control tiles get exactly the same treatment, so we get an SNR at every level. A tile only counts as a hit if it
+        # beats the SNR threshold at all of them.
+        ### ----------------------
+        possible_tiles, control_tiles = self.select_rough_alignment_tiles(side1, possible_tile_keys)
+        tiles = control_tiles + possible_tiles
+        binning = 2 ** pyramid_levels
+        coarse_image_data = self.image_data.binned(binning)
+        coarse_image_data.set_fft((self.fq_im_scaled_dims.astype(np.int) - 1) // binning + 1)
+        correlations = fastqtilercs.fft_align_tiles_with_im(tiles, coarse_image_data, binning)
+        del coarse_image_data
+        passes_all_levels = {tile: True for tile in possible_tiles}
+
+        def check_level(level, correlations):
+            control_corr = max([corr for corr, _ in correlations[:len(control_tiles)]] or [0])
+            for tile, (max_corr, _) in zip(possible_tiles, correlations[len(control_tiles):]):
+                snr = max_corr / control_corr
+                passes_all_levels[tile] &= snr > snr_thresh
+                log.debug('tile# = {}, level = {}, SNR = {}, control_corr = {}, max_corr = {}'.format(tile.key, level, round(snr, 2), round(control_corr, 2), round(max_corr, 2)))
+            return control_corr
+
+        check_level(pyramid_levels, correlations)
+        for level in reversed(range(pyramid_levels)):
+            factor = 2 ** level
+            image_data = self.image_data.binned(factor) if factor > 1 else self.image_data
+            blurred_image = image_data.blurred(tiles[0].cluster_sigma / factor) if tiles else None
+            # Each level doubles the resolution, so the true peak is within a couple of pixels of the upsampled one
+            correlations = [tile.refine_alignment(blurred_image, 2 * align_tr, 2, factor)
+                            for tile, (_, align_tr) in zip(tiles, correlations)]
+            self.control_corr = check_level(level, correlations)
+
+        self.hitting_tiles = []
+        for tile, (max_corr, align_tr) in zip(possible_tiles, correlations[len(control_tiles):]):
+            if passes_all_levels[tile]:
+                tile.set_aligned_rcs(align_tr)
+                tile.snr = max_corr / self.control_corr
+                self.hitting_tiles.append(tile)
+
+    def estimate_rotation_and_scale(self, side1, possible_tile_keys, binning=FOURIER_MELLIN_BINNING):
+        ### ----------------------
+        # Fourier-Mellin estimation of how far off the rotation and scale of the FASTQ data are. Magnitude spectra don't
+        # depend on translation, and in log-polar coordinates a rotation or a scaling becomes a plain shift, which phase
+        # correlation can measure in one pass.
+        # Clusters are randomly placed, so the spectrum of a whole tile says nothing about how an image is oriented. We first
+        # find roughly where the image lands with a cheap binned correlation (which tolerates a few degrees of error), and
+        # compare the image against just that window of the best tile.
+        # Returns the rotation (in degrees) to add to the rotation estimate and the factor to multiply fq_w by.
+        ### ----------------------
+        possible_tiles, _ = self.select_rough_alignment_tiles(side1, possible_tile_keys)
+        if not possible_tiles:
+            return None
+        coarse_image_data = self.image_data.binned(binning)
+        coarse_image_data.set_fft((self.fq_im_scaled_dims.astype(np.int) - 1) // binning + 1)
+        correlations = fastqtilercs.fft_align_tiles_with_im(possible_tiles, coarse_image_data, binning)
+        del coarse_image_data
+        best = int(np.argmax([corr for corr, _ in correlations]))
+        tile, align_tr = possible_tiles[best], correlations[best][1] * binning
+        fq_window = tile.window_image(align_tr, self.image_data.image.shape)
+        image_log_polar, log_radius_step, angle_step = misc.log_polar_magnitude_spectrum(self.image_data.image)
+        tile_log_polar, _, _ = misc.log_polar_magnitude_spectrum(fq_window)
+        (angle_shift, log_radius_shift), peak = misc.phase_correlation_peak(image_log_polar, tile_log_polar)
+        # the shifts describe how the image is transformed relative to the tile, so we correct the tile in the other direction
+        rotation_correction = -np.degrees(angle_shift * angle_step)
+        scale_correction = np.exp(-log_radius_shift * log_radius_step)
+        log.debug('Fourier-Mellin tile# = {}, rotation correction = {}, scale correction = {}, peak = {}'.format(tile.key, round(rotation_correction, 3), round(scale_correction, 4), round(peak, 1)))
+        if abs(rotation_correction) > MAX_FOURIER_MELLIN_ROTATION or abs(scale_correction - 1.0) > MAX_FOURIER_MELLIN_SCALE_CHANGE:
+            log.debug('Ignoring implausible Fourier-Mellin estimate.')
+            return None
+        return rotation_correction, scale_correction
 
     def find_points_in_frame(self, consider_tiles='all'):
         ### ----------------------
@@ -192,38 +331,35 @@ class FastqImageAligner(object):
         # To estimate the points within the FOV, we first compute the X, Y coordinates of each read after transformation (i.e., scaling, rotation, etc.)
         # If the X, Y coordiantes of a read fall within the FOV size, we consider it as a aligned_rcs_in_frame.
         ### ----------------------
-        self.rcs_in_frame = []
-        aligned_rcs_in_frame = []
-        im_shape = self.image_data.image.shape
+        im_shape = np.array(self.image_data.image.shape)
         # Consider tiles are the tiles pass the SNR criteria.
         if consider_tiles == 'all':
             considered_tiles = self.hitting_tiles
         else:
             considered_tiles = [consider_tiles]
 
+        aligned_rcs_in_frame = [np.zeros((0, 2))]
+        rcs_in_frame = [np.zeros((0, 2), dtype=np.int)]
         for tile in considered_tiles:
-            rcs = tile.rcs.astype(np.int)
-            for i, pt in enumerate(tile.aligned_rcs):
-                if 0 <= pt[0] < im_shape[0] and 0 <= pt[1] < im_shape[1]:
-                    aligned_rcs_in_frame.append(pt)
-                    self.rcs_in_frame.append((tile.key, rcs[i]))
-        self.aligned_rcs_in_frame = np.array(aligned_rcs_in_frame)
+            in_frame = np.all((tile.aligned_rcs >= 0) & (tile.aligned_rcs < im_shape), axis=1)
+            aligned_rcs_in_frame.append(tile.aligned_rcs[in_frame])
+            rcs_in_frame.append(tile.rcs[in_frame].astype(np.int))
+        self.aligned_rcs_in_frame = np.concatenate(aligned_rcs_in_frame)
+        self.rcs_in_frame = np.concatenate(rcs_in_frame)
 
     def hit_dists(self, hits):
-        # Here we estimate the euclidean distance between two points.
-        return [self.single_hit_dist(hit) for hit in hits]
-
-    def single_hit_dist(self, hit):
-        # This method is called when we want to estimate two points distance during the precision alignment stage. One in FASTQ space and one in TIFF space.
-        return np.linalg.norm(self.clusters.point_rcs[hit[0]] - self.aligned_rcs_in_frame[hit[1]])
+        # Here we estimate the euclidean distance between two points, for an array of (cluster_index, in_frame_idx) pairs.
+        hits = np.asarray(hits, dtype=np.int).reshape(-1, 2)
+        return np.linalg.norm(self.clusters.point_rcs[hits[:, 0]] - self.aligned_rcs_in_frame[hits[:, 1]], axis=1)
 
     def remove_longest_hits(self, hits, pct_thresh):
         # To be more conservative, we consider the points if distance between the closest neighbor is within the 90-percentile of all closest neighbors set.
-        if not hits:
-            return []
+        hits = np.asarray(hits, dtype=np.int).reshape(-1, 2)
+        if not len(hits):
+            return hits
         dists = self.hit_dists(hits)
         thresh = np.percentile(dists, pct_thresh * 100)
-        return [hit for hit in hits if self.single_hit_dist(hit) <= thresh]
+        return hits[dists <= thresh]
 
     def find_hits(self, consider_tiles='all'):
         ### --------------------------------------------------------------------------------
@@ -231,23 +367,27 @@ class FastqImageAligner(object):
         # It is useful when we want to fine-tune the alignment parameters and find the most probable sequence to register a cluster.
         # The cluster_tree is the tree for TIFF clusters. It is built based on source-extractor identified centroids.
         # The aligned_tree is the tree for FASTQ coordinates. We only consider the FASTQ reads within the FOV.
+        # Hits are stored as arrays of (cluster_index, aligned_in_frame_idx) pairs, one pair per row.
         ### --------------------------------------------------------------------------------
         self.find_points_in_frame(consider_tiles)
-        cluster_tree = KDTree(self.clusters.point_rcs)
-        aligned_tree = KDTree(self.aligned_rcs_in_frame)
-
-        # All indices are in the order (cluster_index, aligned_in_frame_idx)
-        cluster_to_aligned_indexes = set()
-        for i, pt in enumerate(self.clusters.point_rcs):
-            # Providing the TIFF cluster centroids, we want to know what is the closest FASTQ reads in the FASTQ space.
-            dist, idx = aligned_tree.query(pt)
-            cluster_to_aligned_indexes.add((i, idx))
-
-        aligned_to_cluster_indexs_rev = set()
-        for i, pt in enumerate(self.aligned_rcs_in_frame):
-            # In contrast, providing the FASTQ read coordinates, we want to know what is the closest TIFF cluster centroid in the TIFF space.
-            dist, idx = cluster_tree.query(pt)
-            aligned_to_cluster_indexs_rev.add((idx, i))
+        self.classify_hits()
+        if consider_tiles != 'all':
+            self.log_hit_counts()
+
+    def classify_hits(self):
+        # Sorts the hits between the clusters and the current self.aligned_rcs_in_frame. The cluster tree only depends on
+        # the image, so it's built once and reused for every tile and every refinement iteration.
+        cluster_tree = self.clusters.tree
+        aligned_tree = cKDTree(self.aligned_rcs_in_frame)
+        cluster_indexes = np.arange(len(self.clusters.point_rcs))
+        aligned_indexes = np.arange(len(self.aligned_rcs_in_frame))
+
+        # Providing the TIFF cluster centroids, we want to know what is the closest FASTQ reads in the FASTQ space.
+        _, nearest_aligned = aligned_tree.query(self.clusters.point_rcs)
+        # In contrast, providing the FASTQ read coordinates, we want to know what is the closest TIFF cluster centroid in the TIFF space.
+        _, nearest_cluster = cluster_tree.query(self.aligned_rcs_in_frame)
+        cluster_to_aligned_indexes = np.column_stack((cluster_indexes, nearest_aligned))
+        aligned_to_cluster_indexs_rev = np.column_stack((nearest_cluster, aligned_indexes))
 
         ### --------------------------------------------------------------------------------
         # Here we categorize hits into different groups. For the precision alignment to success, the number of exclusive_hits + good_mutual_hits should pass the user-defined threshold (i.e., --min-hits).
@@ -257,13 +397,20 @@ class FastqImageAligner(object):
         # (4) good_mutual_hits: If A and B are mutual_hits but not exclusive, which means that there is either C or D, or both, consider A or B as the closest neighbor. However, the distance between the other candidate is longer than the threshold. Then A and B belong to this category.
         # (5) bad_mutual_hits: If A and B are mutual_hits but not exclusive, neither good mutual. 
         ### --------------------------------------------------------------------------------
-        mutual_hits = cluster_to_aligned_indexes & aligned_to_cluster_indexs_rev # Find the common closest neighbor pairs between the two groups.
-        non_mutual_hits = cluster_to_aligned_indexes ^ aligned_to_cluster_indexs_rev # Find the different closest neighbor pairs.
-
-        cluster_in_non_mutual = set(i for i, j in non_mutual_hits) # Identify the TIFF clusters having more than one closest neighbor by FASTQ reads.
-        aligned_in_non_mutual = set(j for i, j in non_mutual_hits) # Identify the FASTQ reads having more than one closest neighbor by TIFF clusters.
-        exclusive_hits = set((i, j) for i, j in mutual_hits if i not in
-                             cluster_in_non_mutual and j not in aligned_in_non_mutual)
+        # A pair is mutual when the cluster's nearest read has that same cluster as its own nearest cluster.
+        cluster_is_mutual = nearest_cluster[nearest_aligned] == cluster_indexes
+        aligned_is_mutual = nearest_aligned[nearest_cluster] == aligned_indexes
+        mutual_hits = cluster_to_aligned_indexes[cluster_is_mutual]
+        # Each cluster and each read has exactly one nearest neighbor, so the pairs that aren't mutual are all distinct.
+        non_mutual_hits = np.concatenate((cluster_to_aligned_indexes[~cluster_is_mutual],
+                                          aligned_to_cluster_indexs_rev[~aligned_is_mutual]))
+
+        cluster_in_non_mutual = np.zeros(len(cluster_indexes), dtype=np.bool)  # Identify the TIFF clusters having more than one closest neighbor by FASTQ reads.
+        cluster_in_non_mutual[non_mutual_hits[:, 0]] = True
+        aligned_in_non_mutual = np.zeros(len(aligned_indexes), dtype=np.bool)  # Identify the FASTQ reads having more than one closest neighbor by TIFF clusters.
+        aligned_in_non_mutual[non_mutual_hits[:, 1]] = True
+        is_exclusive = ~cluster_in_non_mutual[mutual_hits[:, 0]] & ~aligned_in_non_mutual[mutual_hits[:, 1]]
+        mutual_dists = self.hit_dists(mutual_hits)
 
         # --------------------------------------------------------------------------------
         # Recover good non-exclusive mutual hits. 
@@ -275,11 +422,11 @@ class FastqImageAligner(object):
 
             good_hit_threshold = 5
         else:
-            good_hit_threshold = np.percentile(self.hit_dists(exclusive_hits), 95)
+            good_hit_threshold = np.percentile(mutual_dists[is_exclusive], 95)
         second_neighbor_thresh = 2 * good_hit_threshold
         # To be more conservative, we limit the hits that can be classified as a exclusive_hits by considering only the hit pair closer than the good_hit_threshold.
-        exclusive_hits = set(hit for hit in exclusive_hits
-                             if self.single_hit_dist(hit) <= good_hit_threshold)
+        is_close = mutual_dists <= good_hit_threshold
+        is_exclusive &= is_close
         
         # --------------------------------------------------------------------------------
         # Here we would like to classify the hits to be good_mutual_hits.
@@ -287,25 +434,28 @@ class FastqImageAligner(object):
         # We first consider the hits that are closer than good_hit_threshold as possible good_mutual_hits.
         # Next, take C and A as a candidate pair as an example. If the distance between A and C is longer than the second_neighbor_thresh, then A and B can be consider as good_mutual_hits.
         # In contrast, if the distance between C and A is closer than second_neighbor_thresh, A and B will not be consider as good_mutual_hits.
+        # The closest third wheel of every cluster and every read is found in a single pass over the non-mutual hits.
         # --------------------------------------------------------------------------------
-        good_mutual_hits = set()
-        for i, j in (mutual_hits - exclusive_hits):
-            if self.hit_dists([(i, j)])[0] > good_hit_threshold:
-                continue
-            third_wheels = [tup for tup in non_mutual_hits if i == tup[0] or j == tup[1]]
-            if min(self.hit_dists(third_wheels)) > second_neighbor_thresh:
-                good_mutual_hits.add((i, j))
+        non_mutual_dists = self.hit_dists(non_mutual_hits)
+        closest_third_wheel_to_cluster = np.full(len(cluster_indexes), np.inf)
+        np.minimum.at(closest_third_wheel_to_cluster, non_mutual_hits[:, 0], non_mutual_dists)
+        closest_third_wheel_to_aligned = np.full(len(aligned_indexes), np.inf)
+        np.minimum.at(closest_third_wheel_to_aligned, non_mutual_hits[:, 1], non_mutual_dists)
+        closest_third_wheel = np.minimum(closest_third_wheel_to_cluster[mutual_hits[:, 0]],
+                                         closest_third_wheel_to_aligned[mutual_hits[:, 1]])
+        is_good_mutual = ~is_exclusive & is_close & (closest_third_wheel > second_neighbor_thresh)
         # For all other mutual hit pairs that are not exclusive_hits neither good_mutual_hits, they will be classified as bad_mutual_hits.
-        bad_mutual_hits = mutual_hits - exclusive_hits - good_mutual_hits
+        is_bad_mutual = ~is_exclusive & ~is_good_mutual
+
+        exclusive_hits = mutual_hits[is_exclusive]
+        good_mutual_hits = mutual_hits[is_good_mutual]
+        bad_mutual_hits = mutual_hits[is_bad_mutual]
 
         # --------------------------------------------------------------------------------
         # Test that the four groups form a partition of all hits and finalize
         # --------------------------------------------------------------------------------
-        assert (non_mutual_hits | bad_mutual_hits | good_mutual_hits | exclusive_hits
-                == cluster_to_aligned_indexes | aligned_to_cluster_indexs_rev
-                and len(non_mutual_hits) + len(bad_mutual_hits)
-                + len(good_mutual_hits) + len(exclusive_hits)
-                == len(cluster_to_aligned_indexes | aligned_to_cluster_indexs_rev))
+        assert (len(non_mutual_hits) + len(bad_mutual_hits) + len(good_mutual_hits) + len(exclusive_hits)
+                == len(cluster_indexes) + len(aligned_indexes) - len(mutual_hits))
 
         self.non_mutual_hits = non_mutual_hits
         self.mutual_hits = mutual_hits
@@ -313,110 +463,171 @@ class FastqImageAligner(object):
         self.good_mutual_hits = good_mutual_hits
         self.exclusive_hits = exclusive_hits
 
-        if consider_tiles != 'all':
-            log.debug('Non-mutual hits: %s' % len(non_mutual_hits))
-            log.debug('Mutual hits: %s' % len(mutual_hits))
-            log.debug('Bad mutual hits: %s' % len(bad_mutual_hits))
-            log.debug('Good mutual hits: %s' % len(good_mutual_hits))
-            log.debug('Exclusive hits: %s' % len(exclusive_hits))
+    def log_hit_counts(self):
+        log.debug('Non-mutual hits: %s' % len(self.non_mutual_hits))
+        log.debug('Mutual hits: %s' % len(self.mutual_hits))
+        log.debug('Bad mutual hits: %s' % len(self.bad_mutual_hits))
+        log.debug('Good mutual hits: %s' % len(self.good_mutual_hits))
+        log.debug('Exclusive hits: %s' % len(self.exclusive_hits))
 
-    def least_squares_mapping(self, pct_thresh=0.9, min_hits=50):
+    def least_squares_mapping(self, pct_thresh=0.9, min_hits=50, refinement_iterations=0):
         """least_squares_mapping(self, hit_type='exclusive')
 
         "Input": set of tuples of (cluster_index, in_frame_idx) mappings.
 
         "Output": scaling lambda, rotation theta, x_offset, y_offset, and aligned_rcs
 
-        We here solve the matrix least squares equation Ax = b, where
-
-                [ x0r -y0r 1 0 ]
-                [ y0r  x0r 0 1 ]
-            A = [ x1r -y1r 1 0 ]
-                [ y1r  x1r 0 1 ]
-                      . . .
-                [ xnr -ynr 1 0 ]
-                [ ynr  xnr 0 1 ]
-
-        and
+        We here find the similarity transform (scaling, rotation and offset) that maps the rcs onto the cluster coords with
+        the smallest squared error:
 
-            b = [ x0s y0s x1s y1s . . . xns yns ]^T
+            xs = alpha xr - beta yr + x_offset
+            ys = beta xr + alpha yr + y_offset
 
-        The r and s subscripts indicate rcs and cluster coords.
+        The r and s subscripts indicate rcs and cluster coords, and
 
-        The interpretation of x is then given by
-
-            x = [ alpha beta x_offset y_offset ]^T
-
-        where
             alpha = lambda cos(theta), and
             beta = lambda sin(theta)
 
-        This system of equations is then finally solved for lambda and theta.
+        This has a closed-form solution (see misc.fit_similarity_transform), so there's no need to build the 2N x 4 design
+        matrix of the equivalent linear least squares problem.
+
+        With refinement_iterations > 0, the hits are matched again with the new transform and the transform is solved
+        again (i.e. iterative closest point), until no read moves by more than ICP_TOLERANCE pixels. The reads in the frame
+        are only found after the first solution, and then kept for every iteration.
+
         """
         def get_hits(hit_type):
             if isinstance(hit_type, str):
                 hit_type = [hit_type]
-            hits = []
-            for ht in hit_type:
-                hits.extend(getattr(self, ht + '_hits'))
-            return hits 
+            return np.concatenate([getattr(self, ht + '_hits') for ht in hit_type])
 
         found_good_mapping = False
+        self.converged_tiles = []
 
         for tile in self.hitting_tiles:
-            self.find_hits(consider_tiles=tile)
-            # Reminder: All indices are in the order (cluster_index, in_frame_idx)
-            # We only consider exclusive and good_mutual hits to perform least-square mapping.
-            raw_hits = get_hits(('exclusive', 'good_mutual'))
-            # Remove hit pairs if their distance is longer than preset percentage.
-            hits = self.remove_longest_hits(raw_hits, pct_thresh)
-            # If the number of hits is smaller than the user-defined threshold, skip this tile.
-            if len(hits) < min_hits:
+            self.find_points_in_frame(consider_tiles=tile)
+            transform = None
+            converged = False
+            for iteration in range(refinement_iterations + 1):
+                self.classify_hits()
+                # Reminder: All indices are in the order (cluster_index, in_frame_idx)
+                # We only consider exclusive and good_mutual hits to perform least-square mapping.
+                raw_hits = get_hits(('exclusive', 'good_mutual'))
+                # Remove hit pairs if their distance is longer than preset percentage.
+                hits = self.remove_longest_hits(raw_hits, pct_thresh)
+                # If the number of hits is smaller than the user-defined threshold, skip this tile (or keep the previous
+                # solution, if we're refining).
+                if len(hits) < min_hits:
+                    break
+                transform = misc.fit_similarity_transform(self.rcs_in_frame[hits[:, 1]],
+                                                          self.clusters.point_rcs[hits[:, 0]])
+                if iteration == 0 and refinement_iterations > 0:
+                    # The rough alignment can be off by a few pixels, so we find the reads in the frame once more with
+                    # the first solution. The edges of the frame barely move after that.
+                    tile.set_aligned_rcs_given_transform(*transform)
+                    self.find_points_in_frame(consider_tiles=tile)
+                    continue
+                aligned_rcs_in_frame = misc.similarity_transform(self.rcs_in_frame, *transform)
+                max_shift = np.abs(aligned_rcs_in_frame - self.aligned_rcs_in_frame).max() if len(aligned_rcs_in_frame) else 0.0
+                self.aligned_rcs_in_frame = aligned_rcs_in_frame
+                if refinement_iterations > 0:
+                    log.debug('Refinement iteration %d for tile %s: %d hits, max shift %.3f' % (iteration, tile.key, len(hits), max_shift))
+                if max_shift < ICP_TOLERANCE:
+                    converged = True
+                    break
+            self.log_hit_counts()
+            if transform is None:
                 continue
-            else:
             # If the number of hits is larger than the user-defined threshold, consider this tile.
-                found_good_mapping = True
-            A = np.zeros((2 * len(hits), 4))
-            b = np.zeros((2 * len(hits),))
-            for i, (cluster_index, in_frame_idx) in enumerate(hits):
-                # Extract the adjusted TIFF cluster x, y coordinates in the FOV.
-                tile_key, (xir, yir) = self.rcs_in_frame[in_frame_idx]
-                A[2*i, :] = [xir, -yir, 1, 0]
-                A[2*i+1, :] = [yir,  xir, 0, 1]
-                
-                # Extract the adjusted phiX x, y coordinates in the FOV.
-                xis, yis = self.clusters.point_rcs[cluster_index]
-                b[2*i] = xis
-                b[2*i+1] = yis
-
-            alpha, beta, x_offset, y_offset = np.linalg.lstsq(A, b)[0]
-            offset = np.array([x_offset, y_offset])
-            theta = np.arctan2(beta, alpha)
-            lbda = alpha / np.cos(theta)
-            tile.set_aligned_rcs_given_transform(lbda, theta, offset)
+            found_good_mapping = True
+            if converged:
+                self.converged_tiles.append(tile)
+            tile.set_aligned_rcs_given_transform(*transform)
             tile.set_correlation(self.image_data.image)
             if hasattr(self, 'control_corr'):
                 tile.set_snr_with_control_corr(self.control_corr)
         return found_good_mapping
 
-    def rough_align(self, side1, possible_tile_keys, rotation_est, fq_w_est=927, snr_thresh=1.2):
+    def map_fastq_tiles(self, rotation_est, fq_w_est):
         self.fq_w = fq_w_est
         self.set_fastq_tile_mappings()
         self.set_all_fastq_image_data()
         self.rotate_all_fastq_data(rotation_est)
+
+    def rough_align(self, side1, possible_tile_keys, rotation_est, fq_w_est=927, snr_thresh=1.2, pyramid_levels=0, fourier_mellin=False,
+                    early_exit_snr=None, likely_tile_count=0, noise_floor=None):
+        self.map_fastq_tiles(rotation_est, fq_w_est)
         start_time = time.time()
-        self.find_hitting_tiles(side1, possible_tile_keys, snr_thresh)
+        correction = self.estimate_rotation_and_scale(side1, possible_tile_keys) if fourier_mellin else None
+        if correction is not None:
+            rotation_correction, scale_correction = correction
+            self.map_fastq_tiles(rotation_est + rotation_correction, fq_w_est * scale_correction)
+        self.find_hitting_tiles_at_levels(side1, possible_tile_keys, snr_thresh, pyramid_levels, early_exit_snr, likely_tile_count,
+                                          noise_floor)
+        if correction is not None and not self.hitting_tiles:
+            # the estimate made things worse, so try again with the original rotation and scale
+            log.debug('Nothing aligned after Fourier-Mellin correction, reverting to the estimated rotation and scale.')
+            self.map_fastq_tiles(rotation_est, fq_w_est)
+            self.find_hitting_tiles_at_levels(side1, possible_tile_keys, snr_thresh, pyramid_levels, early_exit_snr, likely_tile_count,
+                                          noise_floor)
         log.debug('Rough alignment time: %.3f seconds' % (time.time() - start_time))
 
-    def precision_align_only(self, min_hits):
+    def rough_align_in_windows(self, side1, alignments, rotation_est, fq_w_est=927, snr_thresh=1.2, margin=WINDOW_MARGIN):
+        """
+        A rough alignment that only considers offsets within margin pixels of predicted tile alignments, given as (tile_key,
+        scaling, tile_width, rotation, rc_offset) tuples. Each tile is cropped to the window that could land in the image
+        before it's correlated, so the FFTs are about twice the size of the image instead of the size of a whole tile.
+
+        """
+        self.map_fastq_tiles(rotation_est, fq_w_est)
+        start_time = time.time()
+        # Where the predicted alignment of each tile puts its pseudo image, relative to the image
+        expected_translations = {}
+        for tile_key, scaling, _, rotation, rc_offset in (alignment[:5] for alignment in alignments):
+            tile = self.fastq_tiles.get(tile_key)
+            if tile is not None and len(tile.rcs):
+                predicted_rcs = misc.similarity_transform(tile.rcs, scaling, rotation, rc_offset)
+                expected_translations[tile_key] = np.median(predicted_rcs - tile.mapped_rcs, axis=0)
+        possible_tiles, control_tiles = self.select_rough_alignment_tiles(side1, sorted(expected_translations))
+        possible_tiles = [tile for tile in possible_tiles if tile.key in expected_translations]
+        self.control_corr = 0
+        self.hitting_tiles = []
+        if not possible_tiles:
+            return
+        window_shape = np.array(self.image_data.image.shape) + 2 * margin
+        windows = [tile.window(-expected_translations[tile.key] - margin, window_shape) for tile in possible_tiles]
+        # The control tiles are cropped in the same place, so that their noise is measured over just as many offsets
+        control_windows = [tile.window(windows[0].origin, window_shape) for tile in control_tiles]
+        self.image_data.set_fft(window_shape)
+        correlations = fastqtilercs.fft_align_tiles_with_im(control_windows + windows, self.image_data)
+        for corr, _ in correlations[:len(control_windows)]:
+            if corr > self.control_corr:
+                self.control_corr = corr
+        correlations = [(max_corr, window.tile_translation(align_tr))
+                        for window, (max_corr, align_tr) in zip(windows, correlations[len(control_windows):])]
+        self.classify_rough_alignments(possible_tiles, correlations, snr_thresh)
+        log.debug('Windowed rough alignment time: %.3f seconds' % (time.time() - start_time))
+
+    def find_hitting_tiles_at_levels(self, side1, possible_tile_keys, snr_thresh, pyramid_levels, early_exit_snr=None, likely_tile_count=0,
+                                     noise_floor=None):
+        if pyramid_levels > 0:
+            # coarse correlations are cheap enough that all of the possible tiles are just tried at once
+            self.find_hitting_tiles_pyramid(side1, possible_tile_keys, pyramid_levels, snr_thresh)
+        else:
+            self.find_hitting_tiles(side1, possible_tile_keys, snr_thresh, early_exit_snr, likely_tile_count, noise_floor)
+
+    def precision_align_only(self, min_hits, refinement_iterations=0):
         start_time = time.time()
         if not self.hitting_tiles:
             raise RuntimeError('Alignment not found')
-        found_good_mapping = self.least_squares_mapping(min_hits=min_hits)
+        found_good_mapping = self.least_squares_mapping(min_hits=min_hits, refinement_iterations=refinement_iterations)
         # If the number of exclusive + good_mutual hits are smaller than the user-defined threshold, the precision alignment will be considered failed.
         if not found_good_mapping:
             raise ValueError("Could not precision align!")
         log.debug('Precision alignment time: %.3f seconds' % (time.time() - start_time))
+        if self.converged_tiles == self.hitting_tiles and len(self.hitting_tiles) == 1:
+            # The last refinement iteration already matched the hits for the final transform
+            return
         start_time = time.time()
         self.find_hits()
         log.debug('Hit finding time: %.3f seconds' % (time.time() - start_time))
@@ -434,7 +645,8 @@ class FastqImageAligner(object):
                                                 [float(tile.width) for tile in self.hitting_tiles],
                                                 [float(tile.rotation_degrees) for tile in self.hitting_tiles],
                                                 offsets,
-                                                hits)
+                                                hits,
+                                                self.predicted)
 
     @property
     def read_names_rcs(self):
@@ -444,6 +656,20 @@ class FastqImageAligner(object):
                 # hack because I don't understand why tiles aren't getting rotations
                 # not having rotations implies they aren't getting aligned at all, which is very bad
                 continue
-            for read_name, pt in izip(tile.read_names, tile.aligned_rcs):
-                if 0 <= pt[0] < im_shape[0] and 0 <= pt[1] < im_shape[1]:
-                    yield '%s\t%f\t%f\n' % (read_name, pt[0], pt[1])
+            # only the names of the reads in the frame are looked up
+            in_frame = np.flatnonzero(np.all((tile.aligned_rcs >= 0) & (tile.aligned_rcs < im_shape), axis=1))
+            for read_name, pt in izip(tile.aligned_read_names(in_frame), tile.aligned_rcs[in_frame]):
+                yield '%s\t%f\t%f\n' % (read_name, pt[0], pt[1])
+
+    @property
+    def read_ids_rcs(self):
+        """ The ids and (r, c) points of the same reads as read_names_rcs, as arrays. """
+        im_shape = self.image_data.image.shape
+        read_ids, rcs = [np.zeros(0, dtype=np.int64)], [np.zeros((0, 2), dtype=np.float32)]
+        for tile in self.hitting_tiles:
+            if not hasattr(tile, 'rotation'):
+                continue
+            in_frame = np.flatnonzero(np.all((tile.aligned_rcs >= 0) & (tile.aligned_rcs < im_shape), axis=1))
+            read_ids.append(tile.aligned_read_ids(in_frame).astype(np.int64))
+            rcs.append(tile.aligned_rcs[in_frame].astype(np.float32))
+        return np.concatenate(read_ids), np.concatenate(rcs)
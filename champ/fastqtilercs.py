@@ -1,28 +1,196 @@
-from copy import deepcopy
+from collections import OrderedDict
+import itertools
 import numpy as np
 import misc
 import logging
+from champ.readnames import ReadNames
 from scipy import ndimage
 
 log = logging.getLogger(__name__)
 
+# Upper bound on the memory used by cached tile spectra in each process
+SPECTRUM_CACHE_BYTES = 2 * 1024 ** 3
+# Unless a budget is given, the caches of all of the workers together use at most this fraction of the available memory
+SPECTRUM_CACHE_MEMORY_FRACTION = 0.25
+# The width of the square buckets that the reads of a tile are sorted into, in FASTQ coordinate units. A field of view
+# is a few thousand units across.
+READ_BUCKET_SIZE = 1000
 
-class FastqTileRCs(object):
-    """A class for fastq tile coordinates."""
-    def __init__(self, key, read_names, microns_per_pixel):
+
+class TileSpectrumCache(object):
+    """
+    Keeps the FFTs of tile pseudo-images around between images. The tile geometry (scale, rotation and FFT size) is the
+    same for every field of view in a run, so there's no reason to render and transform each tile over and over again.
+    Spectra are evicted in least-recently-used order once the memory budget is exceeded.
+
+    """
+    def __init__(self, max_bytes):
+        self._max_bytes = max_bytes
+        self._spectra = OrderedDict()
+        self._nbytes = 0
+
+    def set_budget(self, max_bytes):
+        self._max_bytes = max_bytes
+        while self._spectra and self._nbytes > self._max_bytes:
+            self._nbytes -= self._spectra.popitem(last=False)[1].nbytes
+
+    def get(self, key):
+        spectrum = self._spectra.pop(key, None)
+        if spectrum is not None:
+            # reinsert so this entry becomes the most recently used
+            self._spectra[key] = spectrum
+        return spectrum
+
+    def put(self, key, spectrum):
+        if spectrum.nbytes > self._max_bytes:
+            return
+        if key in self._spectra:
+            self._nbytes -= self._spectra.pop(key).nbytes
+        while self._spectra and self._nbytes + spectrum.nbytes > self._max_bytes:
+            _, evicted = self._spectra.popitem(last=False)
+            self._nbytes -= evicted.nbytes
+        self._spectra[key] = spectrum
+        self._nbytes += spectrum.nbytes
+
+    def clear(self):
+        self._spectra.clear()
+        self._nbytes = 0
+
+    def __len__(self):
+        return len(self._spectra)
+
+    @property
+    def nbytes(self):
+        return self._nbytes
+
+
+# Each worker process gets its own cache since they're forked after this module is imported
+spectrum_cache = TileSpectrumCache(SPECTRUM_CACHE_BYTES)
+# Identifies the reads of tiles that don't come from a tile store
+_unstored_reads_ids = itertools.count()
+
+
+def spectrum_cache_budget(worker_count, budget_mb=None):
+    """
+    The memory (in bytes) that the spectrum cache of each worker may use. Unless a budget is given, it's a share of the
+    available memory, so that a machine with many cores doesn't run out of memory, but never more than
+    SPECTRUM_CACHE_BYTES.
+
+    """
+    if budget_mb is not None:
+        return int(budget_mb * 1024 ** 2)
+    available = misc.available_memory()
+    if available is None:
+        return SPECTRUM_CACHE_BYTES
+    return int(min(SPECTRUM_CACHE_BYTES, SPECTRUM_CACHE_MEMORY_FRACTION * available / max(worker_count, 1)))
+
+
+def set_spectrum_cache_budget(max_bytes):
+    # Runs in each worker process when it starts
+    spectrum_cache.set_budget(max_bytes)
+
+
+class FastqTileReads(object):
+    """
+    The reads of one fastq tile: their names and their coordinates in the sequencer's frame of reference. These never
+    change, so a single instance is shared by the FastqTileRCs of every image that is aligned against the tile.
+
+    """
+    def __init__(self, key, read_names, rcs=None, read_ids=None, source=None):
         self.key = key
-        self.microns_per_pixel = microns_per_pixel
+        # identifies the data of the tile, which the spectrum cache relies on. Tile stores pass their source signature.
+        self.source = source if source is not None else ('reads', next(_unstored_reads_ids))
         self.read_names = read_names
-        self.rcs = np.array([map(int, name.split(':')[-2:]) for name in self.read_names])
+        if rcs is None:
+            rcs = np.array([map(int, name.split(':')[-2:]) for name in self.read_names], dtype=np.int).reshape(-1, 2)
+        self.rcs = rcs
+        self.read_ids = read_ids
+        self.rcs.flags.writeable = False
+        if len(self.rcs):
+            self.rcs_min, self.rcs_max = self.rcs.min(axis=0), self.rcs.max(axis=0)
+        self._buckets = None
+
+    @property
+    def buckets(self):
+        """
+        Sorts the reads into a uniform grid of READ_BUCKET_SIZE buckets. Returns the shape of the grid, the read indexes
+        ordered by bucket, and where each bucket starts in that order (with one extra entry for the end of the last one).
+        This is done the first time it's needed in each process.
+
+        """
+        if self._buckets is None:
+            cells = (self.rcs - self.rcs_min) // READ_BUCKET_SIZE
+            shape = cells.max(axis=0) + 1
+            bucket_ids = cells[:, 0] * shape[1] + cells[:, 1]
+            order = np.argsort(bucket_ids, kind='mergesort')
+            starts = np.searchsorted(bucket_ids[order], np.arange(shape[0] * shape[1] + 1))
+            self._buckets = shape, order, starts
+        return self._buckets
+
+    def indexes_in_box(self, rcs_min, rcs_max):
+        """ The indexes, in ascending order, of the reads in every bucket that overlaps the box from rcs_min to rcs_max. """
+        if not len(self.rcs):
+            return np.zeros(0, dtype=np.int)
+        shape, order, starts = self.buckets
+        first_cell = np.maximum((np.array(rcs_min) - self.rcs_min) // READ_BUCKET_SIZE, 0).astype(np.int)
+        last_cell = np.minimum((np.array(rcs_max) - self.rcs_min) // READ_BUCKET_SIZE, shape - 1).astype(np.int)
+        if np.any(first_cell > last_cell):
+            return np.zeros(0, dtype=np.int)
+        # the buckets in each row of the grid are next to each other in the order
+        indexes = [order[starts[row * shape[1] + first_cell[1]]:starts[row * shape[1] + last_cell[1] + 1]]
+                   for row in range(first_cell[0], last_cell[0] + 1)]
+        return np.sort(np.concatenate(indexes))
+
+
+class FastqTileRCs(object):
+    """A class for fastq tile coordinates. It only holds the alignment of the tile to one image, the reads are shared."""
+    def __init__(self, reads, microns_per_pixel):
+        self.reads = reads
+        self.key = reads.key
+        self.microns_per_pixel = microns_per_pixel
+        self.aligned_indexes = None
+
+    @property
+    def read_names(self):
+        return self.reads.read_names
+
+    @property
+    def rcs(self):
+        return self.reads.rcs
+
+    def aligned_read_names(self, positions):
+        """ The names of the reads at the given positions in aligned_rcs. """
+        indexes = positions if self.aligned_indexes is None else self.aligned_indexes[positions]
+        if isinstance(self.read_names, ReadNames):
+            return self.read_names.take(indexes)
+        return np.asarray(self.read_names)[indexes]
+
+    def aligned_read_ids(self, positions):
+        """ The ids of the reads at the given positions in aligned_rcs, for tiles that come from a tile store. """
+        indexes = positions if self.aligned_indexes is None else self.aligned_indexes[positions]
+        return self.reads.read_ids[indexes]
 
     def set_fastq_image_data(self, offset, scale, scaled_dims, width):
         self.offset = offset
         self.scale = scale
         self.image_shape = scaled_dims
         self.width = width  # width in um
-        self.mapped_rcs = scale * (self.rcs + np.tile(offset, (self.rcs.shape[0], 1))) # Adjust the rcs coordinates according to microscope config.
+        # mapped_rcs is computed when it's first used, since writing the output of an image doesn't need it
+        self._mapped_rcs = None
+        self._mapping = offset, scale
         self.rotation_degrees = 0
 
+    @property
+    def mapped_rcs(self):
+        if self._mapped_rcs is None:
+            offset, scale = self._mapping
+            self._mapped_rcs = scale * (self.rcs + np.tile(offset, (self.rcs.shape[0], 1))) # Adjust the rcs coordinates according to microscope config.
+        return self._mapped_rcs
+
+    @mapped_rcs.setter
+    def mapped_rcs(self, mapped_rcs):
+        self._mapped_rcs = mapped_rcs
+
     def rotate_data(self, degrees):
         self.rotation_degrees += degrees
         self.mapped_rcs = np.dot(self.mapped_rcs, misc.right_rotation_matrix(degrees, degrees=True))
@@ -30,64 +198,242 @@ class FastqTileRCs(object):
         self.image_shape = self.mapped_rcs.max(axis=0) + 1
         return self.image_shape
 
-    # Perform Gaussian blur into phiX cluster to create a pseudo image. The standard deviation of the Gaussian curve is determined by the microscope cofig.
-    def image(self):
-        image = np.zeros(self.image_shape.astype(np.int))
-        image[self.mapped_rcs.astype(np.int)[:, 0], self.mapped_rcs.astype(np.int)[:, 1]] = 1
-        sigma = 0.25 / self.microns_per_pixel  # Clusters have stdev ~= 0.25 um
-        image = ndimage.gaussian_filter(image, sigma)
-        return image
-
-    # Perform FFT to the pseudo phiX images and compute the cross-correlation between FFT phiX image and the FFT TIFF image. 
-    def fft_align_with_im(self, image_data):
-        # Make the ffts
-        fq_image = self.image()
-        padded_fq_im = misc.pad_to_size(fq_image, image_data.fft.shape)
-        fq_im_fft = np.fft.fft2(padded_fq_im)
-        # Align
-        im_data_fft = image_data.fft
-        if im_data_fft.shape != fq_im_fft.shape:
-            raise ValueError("Image and tile matrices are not the same shape! Image:(%dx%d) Tile:(%dx%d)" % (im_data_fft.shape[0],
-                                                                                                             im_data_fft.shape[1],
-                                                                                                             fq_im_fft.shape[0],
-                                                                                                             fq_im_fft.shape[1]))
-        cross_corr = abs(np.fft.ifft2(np.conj(fq_im_fft) * im_data_fft))
-        max_corr = cross_corr.max()
-        max_idx = misc.max_2d_idx(cross_corr)
-        align_tr = np.array(max_idx) - fq_image.shape
-        return max_corr, align_tr
+    @property
+    def cluster_sigma(self):
+        # Clusters have stdev ~= 0.25 um
+        return 0.25 / self.microns_per_pixel
+
+    def binned_points(self, binning):
+        """ Pixel coordinates of each read in the pseudo image, downsampled by the given factor. """
+        return self.mapped_rcs.astype(np.int) // binning
+
+    def binned_image_shape(self, binning):
+        return (self.image_shape.astype(np.int) - 1) // binning + 1
+
+    def conjugate_fft(self, shape, binning=1, dtype=np.complex128):
+        """
+        Returns the complex conjugate of the real FFT of the pseudo image, padded to the given shape. The result only depends
+        on the tile geometry, so it's cached and shared by every image that this process aligns.
+
+        """
+        cache_key = (self.key, self.reads.source, float(self.scale), float(self.rotation_degrees),
+                     tuple(float(o) for o in self.offset), tuple(int(s) for s in shape), binning, np.dtype(dtype).name)
+        spectrum = spectrum_cache.get(cache_key)
+        if spectrum is None:
+            spectrum = self.pseudo_image_fft(shape, binning).astype(dtype, copy=False)
+            np.conj(spectrum, out=spectrum)
+            spectrum_cache.put(cache_key, spectrum)
+        return spectrum
+
+    def pseudo_image_fft(self, shape, binning=1):
+        """
+        Computes the real FFT of the pseudo image (the reads blurred by the point spread function of a cluster, see
+        cluster_sigma) padded to the given shape, without ever building the blurred image. Clusters are splatted straight
+        into the padded buffer and the Gaussian blur is applied as its analytic transfer function in frequency space, which
+        is much cheaper than a spatial convolution over the whole tile.
+
+        With binning > 1, the pseudo image is downsampled to match a microscope image whose pixels were summed in blocks of
+        binning x binning, so each pixel counts all of the clusters that fall into it.
+
+        """
+        assert np.all(self.binned_image_shape(binning) <= np.array(shape)), 'Pseudo image does not fit in the FFT buffer.'
+        return points_fft(self.binned_points(binning), shape, self.cluster_sigma / binning, accumulate=binning > 1)
+
+    def window(self, origin, shape):
+        return TileWindow(self, origin, shape)
+
+    def window_image(self, align_tr, shape):
+        """ Renders the pseudo image of just the part of the tile that lands in an image of the given shape when the tile is
+        translated by align_tr. """
+        image = np.zeros(tuple(int(s) for s in shape))
+        points = self.mapped_rcs.astype(np.int) + np.array(align_tr, dtype=np.int)
+        in_frame = np.all((points >= 0) & (points < np.array(image.shape)), axis=1)
+        image[points[in_frame, 0], points[in_frame, 1]] = 1
+        return ndimage.gaussian_filter(image, self.cluster_sigma)
+
+    def refine_alignment(self, blurred_image, align_tr, radius, binning=1):
+        """
+        Searches a small window of translations around align_tr for the one with the highest correlation between this tile
+        and an image that has already been convolved with the cluster point spread function (see ImageData.blurred). This is
+        the same quantity that the FFT cross-correlation computes, but evaluated only at (2 * radius + 1)^2 offsets.
+
+        Returns the best correlation and its translation.
+
+        """
+        align_tr = np.array(align_tr, dtype=np.int)
+        im_shape = np.array(blurred_image.shape)
+        points = self.binned_points(binning)
+        # Only points that land in the image for at least one of the offsets can contribute to the correlation
+        nearby = np.all((points >= -align_tr - radius) & (points < im_shape - align_tr + radius), axis=1)
+        points = points[nearby]
+        best_corr, best_tr = -np.inf, align_tr
+        for dr in range(-radius, radius + 1):
+            for dc in range(-radius, radius + 1):
+                tr = align_tr + (dr, dc)
+                shifted = points + tr
+                in_frame = np.all((shifted >= 0) & (shifted < im_shape), axis=1)
+                corr = abs(blurred_image[shifted[in_frame, 0], shifted[in_frame, 1]].sum())
+                if corr > best_corr:
+                    best_corr, best_tr = corr, tr
+        return best_corr, best_tr
 
     def set_aligned_rcs(self, align_tr):
         """Returns aligned rcs. Only works when image need not be flipped or rotated."""
-        self.aligned_rcs = deepcopy(self.mapped_rcs)
-        self.aligned_rcs -= np.tile(self.aligned_rcs.min(axis=0), (self.aligned_rcs.shape[0], 1))
-        self.aligned_rcs += np.tile(align_tr, (self.aligned_rcs.shape[0], 1))
-
-    def set_aligned_rcs_given_transform(self, lbda, theta, offset):
-        """Performs transform calculated in FastqImageCorrelator.least_squares_mapping."""
-        A = np.zeros((2*len(self.rcs), 4))
-        for i, pt in enumerate(self.rcs):
-            xir, yir = pt
-            A[2*i, :] = [xir, -yir, 1, 0]
-            A[2*i+1, :] = [yir,  xir, 0, 1]
-
-        x = np.array([lbda * np.cos(theta),
-                      lbda * np.sin(theta),
-                      offset[0],
-                      offset[1]])
+        self.aligned_indexes = None
+        self.aligned_rcs = self.mapped_rcs - self.mapped_rcs.min(axis=0) + align_tr
+
+    def set_aligned_rcs_given_transform(self, lbda, theta, offset, image_shape=None):
+        """
+        Performs transform calculated in FastqImageCorrelator.least_squares_mapping. Given the shape of the image, only the
+        reads in the buckets that can land in it are transformed, and aligned_indexes says which reads those are.
 
+        """
         # First update w since it depends on previous scale setting
         self.width = lbda * float(self.width) / self.scale
         self.scale = lbda
         self.rotation = theta
         self.rotation_degrees = theta * 180.0 / np.pi
         self.offset = offset
-        self.aligned_rcs = np.dot(A, x).reshape((len(self.rcs), 2))
+        if image_shape is None:
+            self.aligned_indexes = None
+            self.aligned_rcs = misc.similarity_transform(self.rcs, lbda, theta, offset)
+            return
+        # The corners of the image in FASTQ coordinates, from the inverse transform
+        corners = np.array([(0, 0), (image_shape[0], 0), (0, image_shape[1]), image_shape], dtype=np.float)
+        corners = misc.similarity_transform(corners - np.asarray(offset), 1.0 / lbda, -theta, (0, 0))
+        self.aligned_indexes = self.reads.indexes_in_box(corners.min(axis=0), corners.max(axis=0))
+        self.aligned_rcs = misc.similarity_transform(self.rcs[self.aligned_indexes], lbda, theta, offset)
 
     def set_correlation(self, im):
         """Sets alignment correlation. Only works when image need not be flipped or rotated."""
-        self.best_max_corr = sum(im[int(x), int(y)] for x, y in self.aligned_rcs
-                                 if 0.0 <= x < im.shape[0] and 0.0 <= y < im.shape[1])
+        in_frame = np.all((self.aligned_rcs >= 0.0) & (self.aligned_rcs < np.array(im.shape)), axis=1)
+        points = self.aligned_rcs[in_frame].astype(np.int)
+        self.best_max_corr = im[points[:, 0], points[:, 1]].sum()
 
     def set_snr_with_control_corr(self, control_corr):
         self.snr = self.best_max_corr / control_corr
+
+
+class TileWindow(object):
+    """
+    The part of a tile's pseudo image that starts at origin (in the coordinates of FastqTileRCs.mapped_rcs) and has the
+    given shape. fft_align_tiles_with_im correlates it like a whole tile, so when we know roughly where a tile lands in an
+    image, the FFTs only need to be big enough for the window instead of the entire tile. The translations it finds are
+    relative to the window, see tile_translation.
+
+    """
+    def __init__(self, tile, origin, shape):
+        self.tile = tile
+        self.origin = np.array(origin, dtype=np.int)
+        self.image_shape = np.array(shape, dtype=np.int)
+        points = tile.mapped_rcs.astype(np.int) - self.origin
+        self.points = points[np.all((points >= 0) & (points < self.image_shape), axis=1)]
+
+    def binned_image_shape(self, binning):
+        assert binning == 1, 'Tile windows are only correlated at full resolution.'
+        return self.image_shape
+
+    def conjugate_fft(self, shape, binning=1, dtype=np.complex128):
+        # Windows depend on the image, so unlike whole tiles, they aren't worth caching
+        assert binning == 1, 'Tile windows are only correlated at full resolution.'
+        return np.conj(points_fft(self.points, shape, self.tile.cluster_sigma)).astype(dtype, copy=False)
+
+    def tile_translation(self, align_tr):
+        return np.array(align_tr) - self.origin
+
+
+def points_fft(points, shape, sigma, accumulate=False):
+    """
+    Computes the real FFT of a pseudo image with a Gaussian of the given standard deviation at each point, padded to the
+    given shape. Points are splatted straight into the padded buffer and the blur is applied as its transfer function, see
+    FastqTileRCs.pseudo_image_fft. With accumulate, each pixel counts all of the points that fall into it.
+
+    """
+    padded_fq_im = np.zeros(tuple(int(s) for s in shape))
+    if accumulate:
+        np.add.at(padded_fq_im, (points[:, 0], points[:, 1]), 1)
+    else:
+        padded_fq_im[points[:, 0], points[:, 1]] = 1
+    spectrum = np.fft.rfft2(padded_fq_im)
+    del padded_fq_im
+    spectrum *= gaussian_transfer_function(spectrum.shape, shape[1], sigma)
+    return spectrum
+
+
+def gaussian_transfer_function(rfft_shape, width, sigma):
+    """
+    The Fourier transform of a normalized 2D Gaussian with standard deviation sigma (in pixels), laid out to match the
+    output of np.fft.rfft2 for a real array with the given number of columns.
+
+    """
+    row_freqs = np.fft.fftfreq(rfft_shape[0])
+    column_freqs = np.fft.rfftfreq(width)
+    assert len(column_freqs) == rfft_shape[1]
+    scale = -2.0 * (np.pi * sigma) ** 2
+    return np.outer(np.exp(scale * row_freqs ** 2), np.exp(scale * column_freqs ** 2))
+
+
+# Reused between images so that we don't allocate a new stack of spectra for every field of view
+_spectrum_stack = None
+
+
+def _get_spectrum_stack(count, shape, dtype=np.complex128):
+    global _spectrum_stack
+    if _spectrum_stack is None or _spectrum_stack.shape != (count,) + tuple(shape) or _spectrum_stack.dtype != dtype:
+        _spectrum_stack = np.empty((count,) + tuple(shape), dtype=dtype)
+    return _spectrum_stack
+
+
+def correlation_nbytes(tile_count, image_data):
+    """
+    Estimates the memory that fft_align_tiles_with_im needs to correlate this many tiles at once against an image whose
+    FFT has been set: the image spectrum, the stack of tile spectra and the cross-correlations.
+
+    """
+    spectrum_nbytes = np.prod(image_data.fft.shape) * image_data.fft.itemsize
+    cross_corr_nbytes = np.prod(image_data.fft_shape) * np.dtype(np.float64).itemsize
+    if image_data.fft.dtype == np.complex64:
+        # one tile at a time, plus the double precision copy of its spectrum that numpy makes
+        return (1 + tile_count) * spectrum_nbytes + cross_corr_nbytes + 2 * spectrum_nbytes
+    return (1 + tile_count) * spectrum_nbytes + tile_count * cross_corr_nbytes
+
+
+def fft_align_tiles_with_im(tiles, image_data, binning=1):
+    """
+    Cross-correlates several tiles against one image at once. The conjugate tile spectra are stacked into a single 3D
+    array, multiplied by the image spectrum in place, and then transformed back with one batched real inverse FFT.
+    Returns a list of (max_corr, align_tr) tuples in the same order as the tiles.
+
+    If the image spectrum is single precision (see ImageData), the spectra are too, and the tiles are transformed back one
+    at a time, since numpy would convert the whole stack to double precision first.
+
+    If the image data has been binned (see ImageData.binned), pass the same binning factor so that the tile pseudo images
+    are downsampled to match. The translations are then in binned pixels.
+
+    """
+    if not tiles:
+        return []
+    im_data_fft = image_data.fft
+    fft_shape = tuple(image_data.fft_shape)
+    stack = _get_spectrum_stack(len(tiles), im_data_fft.shape, im_data_fft.dtype)
+    for i, tile in enumerate(tiles):
+        conj_fq_im_fft = tile.conjugate_fft(fft_shape, binning, im_data_fft.dtype)
+        if conj_fq_im_fft.shape != im_data_fft.shape:
+            raise ValueError("Image and tile matrices are not the same shape! Image:(%dx%d) Tile:(%dx%d)" % (im_data_fft.shape[0],
+                                                                                                             im_data_fft.shape[1],
+                                                                                                             conj_fq_im_fft.shape[0],
+                                                                                                             conj_fq_im_fft.shape[1]))
+        stack[i] = conj_fq_im_fft
+    stack *= im_data_fft
+    if stack.dtype == np.complex64:
+        cross_corrs = (np.fft.irfft2(spectrum, s=fft_shape) for spectrum in stack)
+    else:
+        cross_corrs = np.fft.irfft2(stack, s=fft_shape, axes=(-2, -1))
+    results = []
+    for tile, cross_corr in zip(tiles, cross_corrs):
+        np.abs(cross_corr, out=cross_corr)
+        flat_idx = cross_corr.argmax()
+        max_idx = np.unravel_index(flat_idx, fft_shape)
+        align_tr = np.array(max_idx) - tile.binned_image_shape(binning)
+        results.append((cross_corr.flat[flat_idx], align_tr))
+    return results
@@ -20,7 +20,11 @@ class Image(np.ndarray):
 
     @property
     def index(self):
-        return "%s_%.3d_%.3d" % (self.channel, self.row, self.column)
+        return self.index_format(self.channel, self.row, self.column)
+
+    @staticmethod
+    def index_format(channel, row, column):
+        return "%s_%.3d_%.3d" % (channel, row, column)
 
     def __array_wrap__(self, obj, *_):
         if len(obj.shape) == 0:
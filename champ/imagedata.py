@@ -1,13 +1,18 @@
+from copy import copy
 import numpy as np
 from champ import misc
+from scipy import ndimage
 
 
 class ImageData(object):
     """A class for image data to be correlated with fastq coordinate data."""
-    def __init__(self, filename, um_per_pixel, image):
+    def __init__(self, filename, um_per_pixel, image, single_precision=False):
         assert isinstance(image, np.ndarray), 'Image not numpy ndarray'
         self.fname = str(filename)
         self.fft = None
+        self.fft_shape = None
+        # Spectra are stored as complex64 in single precision, which halves the memory of every FFT buffer
+        self.fft_dtype = np.complex64 if single_precision else np.complex128
         self.image = image
         self.median_normalize()
         self.um_per_pixel = um_per_pixel
@@ -19,14 +24,37 @@ class ImageData(object):
         self.image /= float(med)
         self.image -= 1.0
 
-    # Perform FFT on the TIFF images. Since the cross-correlation computation is more efficient when matrices size is power of 2. We pad constant 0 to the original TIFF image to fulfill this requirement. 
+    # Perform FFT on the TIFF images. Since the cross-correlation computation is more efficient when the matrix dimensions only have small prime factors, we pad constant 0 to the original TIFF image to fulfill this requirement.
     def set_fft(self, padding):
         totalx, totaly = np.array(padding) + np.array(self.image.shape)
-        dimension = int(max(misc.next_power_of_2(totalx),
-                        misc.next_power_of_2(totaly))) # Call the "next_power_of_2" method in the misc.py file to calculate the dimension needed to fit in the TIFF images.
+        # Each dimension is padded separately (call the "next_fast_length" method in the misc.py file), so the buffer
+        # doesn't have to be square
+        dimensions = misc.next_fast_length(totalx), misc.next_fast_length(totaly)
         padded_im = np.pad(self.image,
-                           ((int(padding[0]), dimension - int(totalx)), (int(padding[1]), dimension - int(totaly))),
+                           ((int(padding[0]), dimensions[0] - int(totalx)), (int(padding[1]), dimensions[1] - int(totaly))),
                            mode='constant')
-        if padded_im.shape != (dimension, dimension):
-            raise ValueError("FFT of microscope image is not a power of 2, this will cause the program to stall.")
-        self.fft = np.fft.fft2(padded_im)
\ No newline at end of file
+        if padded_im.shape != dimensions:
+            raise ValueError("FFT of microscope image is not a fast FFT length, this will cause the program to stall.")
+        # The image is real, so we only need half of the spectrum
+        self.fft_shape = padded_im.shape
+        self.fft = np.fft.rfft2(padded_im).astype(self.fft_dtype, copy=False)
+
+    def binned(self, factor):
+        """
+        Returns a copy of this image data downsampled by summing blocks of factor x factor pixels. The image has already
+        been normalized, so we don't normalize it again.
+
+        """
+        binned = copy(self)
+        rows, columns = (np.array(self.image.shape) // factor) * factor
+        binned.image = self.image[:rows, :columns].reshape(rows // factor, factor, columns // factor, factor).sum(axis=(1, 3))
+        binned.fft = None
+        binned.fft_shape = None
+        binned.um_per_pixel = self.um_per_pixel * factor
+        binned.um_dims = binned.um_per_pixel * np.array(binned.image.shape)
+        return binned
+
+    def blurred(self, sigma):
+        """ The image convolved with a Gaussian. Correlating this against cluster positions is equivalent to correlating the
+        image against a pseudo image with clusters of the same width. """
+        return ndimage.gaussian_filter(self.image, sigma, mode='constant')
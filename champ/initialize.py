@@ -28,8 +28,11 @@ def save_metadata(clargs, alignment_channel):
 # The cache file records possible tiles and some parameters during the alignment.
 def save_cache(image_directory, cache):
     filename = os.path.join(image_directory, 'cache.yml')
-    with open(filename, 'w') as f:
+    # Other champ processes in the same run may be reading it, so they should never see a partly written file
+    temporary_filename = '%s.%d.tmp' % (filename, os.getpid())
+    with open(temporary_filename, 'w') as f:
         yaml.dump(cache, f)
+    os.rename(temporary_filename, filename)
 
 # champ h5 command can only be processed if the image file has been initialized. If not, it will pop up this error message.
 def load_metadata(image_directory):
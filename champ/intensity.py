@@ -1,9 +1,10 @@
 import os
+import functools
 import glob
 import re
 import h5py
 import misc
-from champ import hdf5tools
+from champ import hdf5tools, readrcs
 import matplotlib.pyplot as plt
 import numpy as np
 from collections import defaultdict
@@ -51,13 +52,21 @@ class IntensityScores(object):
         im_loc_re = re.compile('Channel_(.+)_Pos_(\d+)_(\d+)_')
         image_parsing_regex = re.compile(r'^(?P<channel>.+)_(?P<minor>\d+)_(?P<major>\d+)_')
         for h5_fpath, results_dir in zip(self.h5_fpaths, results_dirs):
-            results_fpaths = glob.glob(os.path.join(results_dir, '*_all_read_rcs.txt'))
+            results = [(os.path.basename(rfpath), functools.partial(misc.read_names_and_points_given_rcs_fpath, rfpath))
+                       for rfpath in glob.glob(os.path.join(results_dir, '*_all_read_rcs.txt'))]
+            # images aligned with --binary-output are all in one file, named by their image index
+            binary_fpath = os.path.join(results_dir, readrcs.FILENAME)
+            binary_image_indexes = sorted(readrcs.image_ranges(binary_fpath))
+            if binary_image_indexes:
+                binary_read_names = readrcs.load_read_names(binary_fpath)
+                results.extend((image_index + '_', functools.partial(readrcs.load_read_names_and_points, binary_fpath,
+                                                                     image_index, binary_read_names))
+                               for image_index in binary_image_indexes)
             if verbose:
                 print h5_fpath
-                print 'Num results files:', len(results_fpaths)
+                print 'Num results files:', len(results)
 
-            for i, rfpath in enumerate(results_fpaths):
-                rfname = os.path.basename(rfpath)
+            for rfname, load_results in results:
                 try:
                     m = im_loc_re.match(rfname)
                     channel = m.group(1)
@@ -78,8 +87,8 @@ class IntensityScores(object):
                 with h5py.File(h5_fpath) as f:
                     im = np.array(f[channel][pos_key])
 
-                for line in open(rfpath):
-                    read_name, r, c = line.strip().split()
+                read_names, points = load_results()
+                for read_name, (r, c) in zip(read_names, points):
                     if not isimportant(read_name):
                         continue
                     r, c = map(misc.stoftoi, (r, c))
@@ -0,0 +1,225 @@
+import errno
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+
+log = logging.getLogger(__name__)
+# Leases that haven't been renewed for this long (in seconds) are assumed to belong to a process that crashed
+LEASE_DURATION = 600
+# How often (in seconds) the leases that we hold are renewed
+RENEW_INTERVAL = 60
+# How often (in seconds) we look again at work that another process holds the lease for
+POLL_INTERVAL = 10
+
+
+def load(image_directory, run_name):
+    """ Returns the leases of a shared run, or LocalLeases if this process is the only one working on the experiment. """
+    if not run_name:
+        return LocalLeases()
+    return WorkLeases(os.path.join(image_directory, 'leases', run_name))
+
+
+class WorkLeases(object):
+    """
+    Lets several champ processes, on this machine or others that share the image directory, split up the work of one
+    run. A process only does a piece of work (an image, usually) while it holds the lease for it, which is a file in the
+    lease directory. Leases are created by hard linking a file with a unique name to the lease path, since that is
+    atomic on NFS, where opening files exclusively isn't always.
+
+    Held leases are renewed by a background thread. Leases that haven't been renewed for lease_duration seconds belong to
+    processes that crashed (or machines that went away), so they are taken over. The age of a lease is measured against
+    the clock of the file server, so machines with different clocks agree on it. Finished work leaves a .done file
+    behind so that no other process does it again in this run.
+
+    """
+    def __init__(self, directory, lease_duration=LEASE_DURATION, renew_interval=RENEW_INTERVAL, poll_interval=POLL_INTERVAL):
+        self.directory = directory
+        self.lease_duration = lease_duration
+        self.renew_interval = renew_interval
+        self.poll_interval = poll_interval
+        self.owner = '%s.%d.%s' % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self._held = set()
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        self._renewer = threading.Thread(target=self._renew_periodically, name='lease-renewer')
+        self._renewer.daemon = True
+        self._renewer.start()
+
+    def _path(self, key, kind='lease'):
+        return os.path.join(self.directory, '%s.%s' % (key, kind))
+
+    def _now(self):
+        # The modification time that the file server gives a file that we just touched
+        clock_path = self._path(self.owner, 'clock')
+        with open(clock_path, 'a'):
+            os.utime(clock_path, None)
+        return os.stat(clock_path).st_mtime
+
+    def _age(self, path):
+        try:
+            return self._now() - os.stat(path).st_mtime
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+
+    def _owner_of(self, path):
+        try:
+            with open(path) as f:
+                return f.read()
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+
+    def is_done(self, key):
+        return os.path.exists(self._path(key, 'done'))
+
+    def acquire(self, key):
+        """ Takes the lease for key if nobody else holds it and the work isn't done yet. Returns whether we got it. """
+        if self.is_done(key):
+            return False
+        path = self._path(key)
+        if not self._link(path) and not (self._reclaim(key) and self._link(path)):
+            return False
+        if self.is_done(key):
+            # another process finished it and released the lease just before we took it
+            os.remove(path)
+            return False
+        with self._lock:
+            self._held.add(key)
+        return True
+
+    def _link(self, path):
+        unique_path = '%s.%s' % (path, self.owner)
+        with open(unique_path, 'w') as f:
+            f.write(self.owner)
+        try:
+            os.link(unique_path, path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        try:
+            # NFS may report that the link failed when it actually worked (if the reply was lost), and the other way
+            # around, so we only trust the link count
+            return os.stat(unique_path).st_nlink == 2
+        finally:
+            os.remove(unique_path)
+
+    def _reclaim(self, key):
+        # Removes the lease of a process that stopped renewing it. Returns whether there's no lease for key anymore.
+        path = self._path(key)
+        age = self._age(path)
+        if age is None:
+            return True
+        if age < self.lease_duration:
+            return False
+        # Renaming is atomic, so only one process can take the expired lease away
+        stale_path = self._path(key, 'stale.%s' % self.owner)
+        try:
+            os.rename(path, stale_path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return True
+        stale_owner = self._owner_of(stale_path)
+        if self._age(stale_path) < self.lease_duration:
+            # Someone else took over the lease between our checks, and we moved their fresh one. Put it back, unless
+            # yet another process has a lease by now.
+            try:
+                os.link(stale_path, path)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            os.remove(stale_path)
+            return False
+        log.warn("Taking over the lease for %s from %s, which hasn't renewed it in %d seconds." % (key, stale_owner, age))
+        os.remove(stale_path)
+        return True
+
+    def claim(self, items, key_func=str):
+        """ Yields the items that we get the lease for, skipping the ones that are done or that other processes hold. """
+        for item in items:
+            if self.acquire(key_func(item)):
+                yield item
+
+    def rounds(self, items, key_func=str):
+        """
+        Yields a claim() of the items that aren't done yet, again and again until all of them are done. Each round has to
+        be finished, and its leases released, before the next one is taken. Rounds after the first one only get the items
+        that were released without being done, or whose leases expired, so we wait for the other processes in between.
+
+        """
+        remaining = list(items)
+        while remaining:
+            yield self.claim(remaining, key_func)
+            remaining = [item for item in remaining if not self.is_done(key_func(item))]
+            if remaining:
+                log.debug("Waiting for other processes to finish %d items." % len(remaining))
+                time.sleep(self.poll_interval)
+
+    def release(self, key, done=True):
+        """ Gives up the lease for key. If done is True, no other process will do this work in this run. """
+        with self._lock:
+            self._held.discard(key)
+        if done:
+            open(self._path(key, 'done'), 'w').close()
+        path = self._path(key)
+        if self._owner_of(path) == self.owner:
+            os.remove(path)
+
+    def renew(self):
+        with self._lock:
+            held = list(self._held)
+        for key in held:
+            path = self._path(key)
+            if self._owner_of(path) != self.owner:
+                log.warn("Lost the lease for %s. Another process may be doing the same work." % key)
+                continue
+            os.utime(path, None)
+
+    def _renew_periodically(self):
+        while not self._closed.wait(self.renew_interval):
+            try:
+                self.renew()
+            except (IOError, OSError) as e:
+                # the file server might just be slow, so we try again next time
+                log.warn("Could not renew leases: %s" % e)
+
+    def close(self):
+        """ Stops renewing the leases, and releases the ones that we still hold so other processes can do that work. """
+        self._closed.set()
+        self._renewer.join()
+        with self._lock:
+            held = list(self._held)
+        for key in held:
+            self.release(key, done=False)
+        clock_path = self._path(self.owner, 'clock')
+        if os.path.exists(clock_path):
+            os.remove(clock_path)
+
+
+class LocalLeases(object):
+    """ Stands in for WorkLeases when only one process works on the experiment, so it gets every lease. """
+    def acquire(self, key):
+        return True
+
+    def claim(self, items, key_func=str):
+        return iter(items)
+
+    def rounds(self, items, key_func=str):
+        yield iter(items)
+
+    def release(self, key, done=True):
+        pass
+
+    def close(self):
+        pass
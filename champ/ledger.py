@@ -0,0 +1,245 @@
+import logging
+import os
+import re
+import sqlite3
+import yaml
+from champ import stats, readrcs
+
+log = logging.getLogger(__name__)
+FILENAME = 'ledger.sqlite'
+# How long (in seconds) to wait for other processes that are writing to the ledger. Writes only take milliseconds, so
+# waiting longer than this means that the locking is broken.
+BUSY_TIMEOUT = 30
+ALIGNED = 'aligned'
+FAILED = 'failed'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS alignments (
+    base_name TEXT NOT NULL,
+    image_index TEXT NOT NULL,
+    channel TEXT NOT NULL,
+    image_row INTEGER NOT NULL,
+    image_column INTEGER NOT NULL,
+    cluster_strategy TEXT,
+    status TEXT NOT NULL,
+    score INTEGER,
+    exclusive_hits INTEGER,
+    good_mutual_hits INTEGER,
+    bad_mutual_hits INTEGER,
+    non_mutual_hits INTEGER,
+    tile_keys TEXT,
+    stats TEXT,
+    started REAL,
+    finished REAL,
+    PRIMARY KEY (base_name, image_index)
+);
+CREATE INDEX IF NOT EXISTS alignments_by_channel ON alignments (base_name, channel, status, image_column, image_row);
+"""
+
+# Connections of this process, keyed by ledger path. SQLite connections can't be used after a fork, so each worker
+# process opens its own.
+_connections = {}
+
+
+stats_file_regex = re.compile(r'''^(\w+)_(?P<row>\d+)_(?P<column>\d+)_stats\.txt$''')
+
+
+def load(results_directory, shared=False):
+    """
+    Returns the ledger of an experiment. Runs that several machines share (see lease.WorkLeases) use the stats files
+    instead, since the results are then usually on NFS, where SQLite can't be used safely.
+
+    """
+    if shared:
+        return StatsFiles(results_directory)
+    return Ledger(os.path.join(results_directory, FILENAME))
+
+
+class Ledger(object):
+    """
+    The status of every image of an experiment, with the stats, score and timing of its alignment, in one SQLite
+    database. Resume checks and the list of images whose data channels can be aligned are indexed queries here, instead
+    of listing the results directories and parsing a stats file for each image. The stats files are still written, and
+    the ones from runs before the ledger existed are imported by align.import_stats_files.
+
+    Any number of processes on one machine can write to the ledger. Like the stats files, an image only has one
+    alignment, which is never replaced by a failed attempt.
+
+    The ledger relies on SQLite's file locking, so it's only safe on local file systems (ext4, xfs, tmpfs and the like).
+    Over NFS and other network file systems the locks can't be relied on, even from a single machine, and the file can
+    be corrupted or read in the middle of a write. Use StatsFiles there.
+
+    """
+    def __init__(self, path):
+        self.path = path
+
+    @property
+    def _connection(self):
+        pid, connection = _connections.get(self.path, (None, None))
+        if pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT)
+            with connection:
+                connection.executescript(SCHEMA)
+            _connections[self.path] = os.getpid(), connection
+        return connection
+
+    def _query(self, sql, *parameters):
+        return self._connection.execute(sql, parameters).fetchall()
+
+    def record_alignment(self, base_name, image_index, channel, row, column, alignment_stats, cluster_strategy=None,
+                         started=None, finished=None):
+        self.record_alignments([(base_name, image_index, channel, row, column, alignment_stats, cluster_strategy, started,
+                                 finished)])
+
+    def record_alignments(self, alignments):
+        """
+        Records several alignments at once, as (base_name, image_index, ..., finished) tuples like the arguments of
+        record_alignment. An alignment that can't be recorded is picked up from its stats file by the next run.
+
+        """
+        rows = []
+        for base_name, image_index, channel, row, column, alignment_stats, cluster_strategy, started, finished in alignments:
+            hits = alignment_stats._data['hits']
+            rows.append((_name(base_name), image_index, channel, row, column, cluster_strategy, ALIGNED, alignment_stats.score,
+                         hits['exclusive'], hits['good_mutual'], hits['bad_mutual'], hits['non_mutual'],
+                         ','.join(str(tile_key) for tile_key, _, _, _, _, _ in alignment_stats),
+                         alignment_stats.serialized, started, finished))
+        try:
+            with self._connection as connection:
+                connection.executemany("INSERT OR REPLACE INTO alignments VALUES (%s)" % ', '.join('?' * 16), rows)
+        except sqlite3.OperationalError as e:
+            log.warn("Could not record %d alignments in %s: %s" % (len(rows), self.path, e))
+
+    def record_failure(self, base_name, image_index, channel, row, column, cluster_strategy=None, started=None, finished=None):
+        # an image that some other attempt did align stays aligned
+        try:
+            with self._connection as connection:
+                connection.execute("INSERT OR REPLACE INTO alignments (base_name, image_index, channel, image_row, image_column, "
+                                   "cluster_strategy, status, started, finished) SELECT ?, ?, ?, ?, ?, ?, ?, ?, ? WHERE NOT "
+                                   "EXISTS (SELECT 1 FROM alignments WHERE base_name = ? AND image_index = ? AND status = ?)",
+                                   (_name(base_name), image_index, channel, row, column, cluster_strategy, FAILED, started,
+                                    finished, _name(base_name), image_index, ALIGNED))
+        except sqlite3.OperationalError as e:
+            # it's only bookkeeping
+            log.warn("Could not record the failed alignment of %s in %s: %s" % (image_index, self.path, e))
+
+    def score(self, base_name, image_index):
+        """ The score of the alignment of an image, or 0 if it isn't aligned. """
+        rows = self._query("SELECT score FROM alignments WHERE base_name = ? AND image_index = ? AND status = ?",
+                           _name(base_name), image_index, ALIGNED)
+        return rows[0][0] if rows else 0
+
+    def alignment_stats(self, base_name, image_index):
+        """ The AlignmentStats of an image, or None if it isn't aligned. """
+        rows = self._query("SELECT stats FROM alignments WHERE base_name = ? AND image_index = ? AND status = ?",
+                           _name(base_name), image_index, ALIGNED)
+        return stats.AlignmentStats().from_string(rows[0][0]) if rows else None
+
+    def aligned_image_indexes(self, base_name):
+        return set(image_index for image_index, in self._query("SELECT image_index FROM alignments WHERE base_name = ? AND "
+                                                               "status = ?", _name(base_name), ALIGNED))
+
+    def aligned_images(self, base_name, channel, column=None):
+        """ The (image index, row, column) of every aligned image of a channel, optionally only those in one column. """
+        return self._query_aligned("image_index, image_row, image_column", base_name, channel, column)
+
+    def aligned_stats(self, base_name, channel, column=None):
+        """ Like aligned_images, but returns (row, column, AlignmentStats) tuples. """
+        return [(row, column, stats.AlignmentStats().from_string(serialized))
+                for row, column, serialized in self._query_aligned("image_row, image_column, stats", base_name, channel, column)]
+
+    def _query_aligned(self, fields, base_name, channel, column):
+        # answered from the alignments_by_channel index
+        where, parameters = "base_name = ? AND channel = ? AND status = ?", (_name(base_name), channel, ALIGNED)
+        if column is not None:
+            where, parameters = where + " AND image_column = ?", parameters + (column,)
+        return self._query("SELECT %s FROM alignments WHERE %s ORDER BY image_column, image_row" % (fields, where), *parameters)
+
+
+class StatsFiles(object):
+    """
+    Answers the same questions as Ledger from the stats files in the results directories, which is how it was done
+    before there was a ledger. This is a lot slower, since it has to list the directories and parse the files, but it
+    only needs files that are written once by one process, so it works on any file system. Recording does nothing,
+    because write_output writes the stats files anyway.
+
+    Like in the ledger, an image only counts as aligned once its reads have been written too.
+
+    """
+    def __init__(self, results_directory):
+        self.results_directory = results_directory
+
+    def record_alignment(self, *args, **kwargs):
+        pass
+
+    def record_alignments(self, alignments):
+        pass
+
+    def record_failure(self, *args, **kwargs):
+        pass
+
+    def score(self, base_name, image_index):
+        alignment_stats = self.alignment_stats(base_name, image_index)
+        return alignment_stats.score if alignment_stats is not None else 0
+
+    def alignment_stats(self, base_name, image_index):
+        directory = os.path.join(self.results_directory, base_name)
+        alignment_stats = load_stats_file(os.path.join(directory, '{}_stats.txt'.format(image_index)))
+        if alignment_stats is None or alignment_stats.score <= 0:
+            return None
+        if not os.path.exists(os.path.join(directory, '{}_all_read_rcs.txt'.format(image_index))) and \
+                image_index not in readrcs.image_ranges(os.path.join(directory, readrcs.FILENAME)):
+            return None
+        return alignment_stats
+
+    def aligned_image_indexes(self, base_name):
+        return set(image_index for image_index, _, _, _, _ in self.alignments(base_name))
+
+    def aligned_images(self, base_name, channel, column=None):
+        return [(image_index, row, image_column) for image_index, _, row, image_column, _ in self.alignments(base_name, channel, column)]
+
+    def aligned_stats(self, base_name, channel, column=None):
+        return [(row, image_column, alignment_stats) for _, _, row, image_column, alignment_stats in self.alignments(base_name, channel, column)]
+
+    def alignments(self, base_name, channel=None, column=None, skip=()):
+        """
+        Returns the (image index, channel, row, column, AlignmentStats) of the aligned images of an HDF5 file, optionally
+        only those of one channel and column. The stats files of the images in skip aren't parsed.
+
+        """
+        directory = os.path.join(self.results_directory, base_name)
+        filenames = set(os.listdir(directory))
+        binary_images = readrcs.image_ranges(os.path.join(directory, readrcs.FILENAME))
+        alignments = []
+        for filename in filenames:
+            match = stats_file_regex.match(filename)
+            if not match or (channel is not None and match.group(1) != channel) \
+                    or (column is not None and int(match.group('column')) != column):
+                continue
+            image_index = filename[:-len('_stats.txt')]
+            if image_index in skip:
+                continue
+            if '{}_all_read_rcs.txt'.format(image_index) not in filenames and image_index not in binary_images:
+                # it was interrupted before its reads were written
+                continue
+            alignment_stats = load_stats_file(os.path.join(directory, filename))
+            if alignment_stats is not None and alignment_stats.score > 0:
+                alignments.append((image_index, match.group(1), int(match.group('row')), int(match.group('column')),
+                                   alignment_stats))
+        return sorted(alignments, key=lambda alignment: (alignment[3], alignment[2]))
+
+
+def load_stats_file(stats_file_path):
+    # Returns None if the image isn't aligned (yet). Other processes might be writing the file while we read it.
+    if not os.path.isfile(stats_file_path):
+        return None
+    with open(stats_file_path) as f:
+        try:
+            return stats.AlignmentStats().from_file(f)
+        except (TypeError, ValueError, KeyError, yaml.YAMLError):
+            return None
+
+
+def _name(base_name):
+    # The base name of an HDF5 file has its directory in it, which depends on how the image directory was given
+    return os.path.basename(base_name)
@@ -5,7 +5,7 @@ Usage:
   champ map FASTQ_DIRECTORY OUTPUT_DIRECTORY [--log-p-file=LOG_P_FILE] [--target-sequence-file=TARGET_SEQUENCE_FILE] [--phix-bowtie=PHIX_BOWTIE] [--min-len=MIN_LEN] [--max-len=MAX_LEN] [--include-side-1] [-v | -vv | -vvv]
   champ init IMAGE_DIRECTORY READ_NAMES_DIRECTORY [ALIGNMENT_CHANNEL] [--perfect-target-name=PERFECT_TARGET_NAME] [--neg-control-target-name=NEG_CONTROL_TARGET_NAME] [--alternate-perfect-reads=ALTERNATE_PERFECT_READS] [--alternate-good-reads=ALTERNATE_GOOD_READS] [--alternate-fiducial-reads=ALTERNATE_FIDUCIAL_READS] [--microns-per-pixel=0.266666666] [--chip=miseq] [--ports-on-right] [--flipud] [--fliplr] [-v | -vv | -vvv ]
   champ h5 IMAGE_DIRECTORY [--min-column=MINCOL] [--max-column=MAXCOL] [-v | -vv | -vvv]
-  champ align IMAGE_DIRECTORY [--rotation-adjustment=ROTATION_ADJUSTMENT] [--min-hits=MIN_HITS] [--snr=SNR] [--process-limit=PROCESS_LIMIT] [--side1] [--make-pdfs] [--fiducial-only] [-v | -vv | -vvv]
+  champ align IMAGE_DIRECTORY [--rotation-adjustment=ROTATION_ADJUSTMENT] [--min-hits=MIN_HITS] [--snr=SNR] [--process-limit=PROCESS_LIMIT] [--side1] [--pyramid-levels=PYRAMID_LEVELS] [--fourier-mellin] [--refinement-iterations=REFINEMENT_ITERATIONS] [--neighbor-priors] [--stage-model] [--learn-tile-map] [--noise-floor] [--single-precision] [--spectrum-cache-mb=SPECTRUM_CACHE_MB] [--max-tasks-per-worker=MAX_TASKS_PER_WORKER] [--window-margin=WINDOW_MARGIN] [--run-name=RUN_NAME] [--binary-output] [--make-pdfs] [--fiducial-only] [-v | -vv | -vvv]
   champ info IMAGE_DIRECTORY
   champ notebooks
 
@@ -1,9 +1,12 @@
 """
 A space for miscellaneous useful functions.
 """
+import os
 import re
 import numpy as np
 from sklearn.neighbors import KernelDensity
+from scipy import ndimage
+from scipy.fftpack import next_fast_len
 from scipy.optimize import minimize
 
 # Compute the next_power_of_2 when transforming phiX images and TIFF images into Fourier space.
@@ -11,6 +14,27 @@ def next_power_of_2(x):
     return 1 << (int(np.ceil(x))-1).bit_length()
 
 
+# The smallest length of at least x with no prime factors other than 2, 3 and 5, which FFTs handle about as quickly as
+# powers of 2. These are much closer together, so we waste a lot less memory on padding.
+def next_fast_length(x):
+    return next_fast_len(int(np.ceil(x)))
+
+
+def available_memory():
+    """ The memory (in bytes) that can be used without swapping, or None if we can't tell. """
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
 def max_2d_idx(a):
     return np.unravel_index(a.argmax(), a.shape)
 
@@ -21,6 +45,61 @@ def pad_to_size(M, size):
     return np.pad(M, ((0, left_to_pad[0]), (0, left_to_pad[1])), mode='constant')
 
 
+def log_polar_magnitude_spectrum(image, num_angles=360, num_radii=256, max_radius_fraction=0.25):
+    """
+    Resamples the magnitude of the Fourier transform of an image onto a log-polar grid. Rotating the image shifts the
+    result along the first axis and scaling it shifts the result along the second, while translations have no effect at
+    all. This is the basis of the Fourier-Mellin transform.
+
+    Only frequencies up to max_radius_fraction of the Nyquist frequency are used, since the spectrum of blurry point
+    clouds is dominated by noise beyond that.
+
+    Returns the log-polar spectrum, the log-radius step and the angle step (in radians) of the grid.
+
+    """
+    window = np.outer(np.hanning(image.shape[0]), np.hanning(image.shape[1]))
+    spectrum = np.abs(np.fft.fftshift(np.fft.fft2((image - image.mean()) * window)))
+    # emphasize the high frequencies since the low ones are mostly the window and the blur
+    row_freqs = np.fft.fftshift(np.fft.fftfreq(image.shape[0]))
+    column_freqs = np.fft.fftshift(np.fft.fftfreq(image.shape[1]))
+    x = np.outer(np.cos(np.pi * row_freqs), np.cos(np.pi * column_freqs))
+    spectrum *= (1.0 - x) * (2.0 - x)
+    center = np.array(image.shape) // 2
+    max_radius = min(center) * max_radius_fraction
+    log_radius_step = np.log(max_radius) / num_radii
+    angle_step = np.pi / num_angles
+    # The magnitude spectrum of a real image is symmetric, so we only need half a turn
+    angles = np.arange(num_angles) * angle_step
+    radii = np.exp(np.arange(num_radii) * log_radius_step)
+    rows = center[0] + np.outer(np.sin(angles), radii)
+    columns = center[1] + np.outer(np.cos(angles), radii)
+    log_polar = ndimage.map_coordinates(spectrum, [rows, columns], order=1)
+    return log_polar, log_radius_step, angle_step
+
+
+def phase_correlation_peak(a, b):
+    """
+    Finds the circular shift that best maps b onto a using phase correlation, with sub-pixel precision from a parabolic
+    fit around the peak. Returns the shift along each axis and the height of the peak relative to the mean.
+
+    """
+    cross_power = np.fft.fft2(a) * np.conj(np.fft.fft2(b))
+    cross_power /= np.abs(cross_power) + 1e-12
+    corr = np.abs(np.fft.ifft2(cross_power))
+    peak = max_2d_idx(corr)
+    shifts = []
+    for axis, idx in enumerate(peak):
+        line = corr[:, peak[1]] if axis == 0 else corr[peak[0], :]
+        left, center, right = line[idx - 1], line[idx], line[(idx + 1) % len(line)]
+        denominator = left - 2 * center + right
+        sub_pixel = 0.5 * (left - right) / denominator if denominator != 0 else 0.0
+        # shifts past the halfway point wrap around to negative shifts
+        if idx > len(line) // 2:
+            idx -= len(line)
+        shifts.append(idx + sub_pixel)
+    return shifts, corr.max() / corr.mean()
+
+
 def right_rotation_matrix(angle, degrees=True):
     if degrees:
         angle *= np.pi / 180.0
@@ -30,6 +109,42 @@ def right_rotation_matrix(angle, degrees=True):
                      [-sina, cosa]])
 
 
+def similarity_transform(rcs, lbda, theta, offset):
+    """
+    Scales points by lbda, rotates them by theta (in radians) and then translates them by offset, that is:
+
+        x' = lbda * (x cos(theta) - y sin(theta)) + x_offset
+        y' = lbda * (x sin(theta) + y cos(theta)) + y_offset
+
+    """
+    alpha, beta = lbda * np.cos(theta), lbda * np.sin(theta)
+    return np.dot(rcs, np.array([[alpha, beta],
+                                 [-beta, alpha]])) + np.asarray(offset)
+
+
+def fit_similarity_transform(src, dst):
+    """
+    Finds the scaling, rotation and offset (as used by similarity_transform) that map the src points onto the dst points
+    with the smallest squared error. This is the closed-form solution to the linear least squares problem in
+    alpha = lbda cos(theta), beta = lbda sin(theta) and the offset: after centering both point sets, alpha and beta are
+    just normalized dot and cross products (Umeyama's method, restricted to two dimensions and no reflections).
+
+    Returns lbda, theta and the offset.
+
+    """
+    src = np.asarray(src, dtype=np.float)
+    dst = np.asarray(dst, dtype=np.float)
+    src_mean, dst_mean = src.mean(axis=0), dst.mean(axis=0)
+    src_centered, dst_centered = src - src_mean, dst - dst_mean
+    src_variance = (src_centered ** 2).sum()
+    alpha = (src_centered * dst_centered).sum() / src_variance
+    beta = (src_centered[:, 0] * dst_centered[:, 1] - src_centered[:, 1] * dst_centered[:, 0]).sum() / src_variance
+    lbda = np.hypot(alpha, beta)
+    theta = np.arctan2(beta, alpha)
+    offset = dst_mean - similarity_transform(src_mean, lbda, theta, (0.0, 0.0))
+    return lbda, theta, offset
+
+
 def strisfloat(x):
     try:
         a = float(x)
@@ -67,10 +182,15 @@ def parse_concentration(filename):
         raise ValueError('Can only handle pM and nM at the moment.')
 
 
-def read_names_and_points_given_rcs_fpath(rcs_fpath):
+def read_names_and_points_given_rcs_fpath(rcs_fpath, image_index=None):
     """
-    Return the read names and (r, c) point locations of points in implied image.
+    Return the read names and (r, c) point locations of points in implied image. A binary results file (see readrcs)
+    holds every image of an HDF5 file, so the image index has to be given for those.
     """
+    if rcs_fpath.endswith('.h5'):
+        # imported here since readrcs depends on modules that import this one
+        from champ import readrcs
+        return readrcs.load_read_names_and_points(rcs_fpath, image_index)
     read_names, points = [], []
     for line in open(rcs_fpath):
         var = line.strip().split()
@@ -269,15 +269,15 @@ def plot_hit_hists(fia, ax=None):
     non_mut_dists = fia.hit_dists(fia.non_mutual_hits)
     bins = np.linspace(0, max(non_mut_dists), 50)
 
-    if non_mut_dists:
+    if len(non_mut_dists):
         ax.hist(non_mut_dists, bins, label='Non-mutual hits', normed=True, histtype='step')
-    if fia.bad_mutual_hits:
+    if len(fia.bad_mutual_hits):
         ax.hist(fia.hit_dists(fia.bad_mutual_hits), bins,
                 label='Bad mutual hits', normed=True, histtype='step')
-    if fia.good_mutual_hits:
+    if len(fia.good_mutual_hits):
         ax.hist(fia.hit_dists(fia.good_mutual_hits), bins, label='Good mutual hits',
                 normed=True, histtype='step')
-    if fia.exclusive_hits:
+    if len(fia.exclusive_hits):
         ax.hist(fia.hit_dists(fia.exclusive_hits), bins, label='Exclusive hits',
                 normed=True, histtype='step')
     ax.legend()
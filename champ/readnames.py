@@ -0,0 +1,90 @@
+import mmap
+import os
+import numpy as np
+
+BLOB_FILENAME = 'names.blob'
+OFFSETS_FILENAME = 'names.offsets'
+OFFSETS_DTYPE = np.int64
+# Iterating over the names copies them out of the blob this many at a time
+ITERATION_CHUNK_SIZE = 65536
+
+
+class ReadNames(object):
+    """
+    The names of a range of reads, stored back to back in one byte blob. The name of read i runs from offsets[i] to
+    offsets[i + 1], so a read costs its characters plus 8 bytes instead of a Python string each. Both are usually
+    memory-mapped, and every tile of a store gets a ReadNames over its own range of them. Read ids are positions in the
+    offset table, so they're unique within the store.
+
+    """
+    def __init__(self, blob, offsets, start=0, stop=None):
+        self.blob = blob
+        self.offsets = offsets
+        self.start = start
+        self.stop = len(offsets) - 1 if stop is None else stop
+
+    @classmethod
+    def load(cls, directory):
+        """ Memory-maps the blob and offsets that write() saved in directory. """
+        blob_path = os.path.join(directory, BLOB_FILENAME)
+        if os.path.getsize(blob_path) == 0:
+            # there's nothing to map
+            return cls('', np.zeros(1, dtype=OFFSETS_DTYPE))
+        with open(blob_path, 'rb') as f:
+            # slices of an mmap are plain strings, which makes looking up names cheap
+            blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(blob, np.memmap(os.path.join(directory, OFFSETS_FILENAME), dtype=OFFSETS_DTYPE, mode='r'))
+
+    def subset(self, start, stop):
+        return ReadNames(self.blob, self.offsets, self.start + start, self.start + stop)
+
+    @property
+    def read_ids(self):
+        return np.arange(self.start, self.stop)
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return self.take(range(*i.indices(len(self))))
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return self.name(self.start + i)
+
+    def __iter__(self):
+        for start in xrange(0, len(self), ITERATION_CHUNK_SIZE):
+            for read_name in self.take(np.arange(start, min(start + ITERATION_CHUNK_SIZE, len(self)))):
+                yield read_name
+
+    def name(self, read_id):
+        return self.blob[int(self.offsets[read_id]):int(self.offsets[read_id + 1])]
+
+    def take(self, indexes):
+        """ The names of the reads at the given indexes, as a list. """
+        read_ids = self.start + np.asarray(indexes, dtype=np.int)
+        if not len(read_ids):
+            return []
+        return [self.blob[start:end] for start, end in zip(self.offsets[read_ids].tolist(), self.offsets[read_ids + 1].tolist())]
+
+
+def write(directory, tile_read_names):
+    """
+    Writes the names of each tile in a [(tile key, [read names])] list to one blob, one tile after the other. Returns the
+    (start, stop) range of each tile's reads in a {tile key: (start, stop)} dictionary.
+
+    """
+    tile_ranges, position, read_count = {}, 0, 0
+    with open(os.path.join(directory, BLOB_FILENAME), 'wb') as blob, open(os.path.join(directory, OFFSETS_FILENAME), 'wb') as offsets:
+        offsets.write(np.zeros(1, dtype=OFFSETS_DTYPE).tostring())
+        for key, read_names in tile_read_names:
+            lengths = np.array([len(read_name) for read_name in read_names], dtype=OFFSETS_DTYPE)
+            blob.write(''.join(read_names))
+            offsets.write((position + np.cumsum(lengths)).astype(OFFSETS_DTYPE).tostring())
+            position += lengths.sum()
+            tile_ranges[key] = [read_count, read_count + len(read_names)]
+            read_count += len(read_names)
+    return tile_ranges
+
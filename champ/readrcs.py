@@ -0,0 +1,109 @@
+import fcntl
+import os
+from contextlib import contextmanager
+import h5py
+import numpy as np
+from champ import tilestore
+
+# The aligned reads of all of the images of an HDF5 file are kept together in its results directory
+FILENAME = 'all_read_rcs.h5'
+GROUP = 'all_read_rcs'
+# The datasets grow by whole chunks of this many reads as images are added
+CHUNK_SIZE = 65536
+# Read ids are numbered within the tile index of all_read_names.txt, see tilestore.TileStore
+READ_IDS_DTYPE = np.int64
+RCS_DTYPE = np.float32
+
+
+def results_path(results_directory, base_name):
+    return os.path.join(results_directory, base_name, FILENAME)
+
+
+@contextmanager
+def _locked(path, operation):
+    # Worker processes (and other machines, in a shared run) add images to the same file, which HDF5 can't handle by
+    # itself. POSIX locks also work over NFS.
+    with open(path + '.lock', 'a+') as lock_file:
+        fcntl.lockf(lock_file, operation)
+        try:
+            yield
+        finally:
+            fcntl.lockf(lock_file, fcntl.LOCK_UN)
+
+
+def write(path, image_index, read_ids, rcs, tile_store):
+    """
+    Adds the ids and (r, c) points of the reads in an aligned image. The ids refer to the reads of tile_store, which has to
+    be a tile index (see tilestore.load_index) so that they can still be looked up later. Writing an image again replaces
+    the earlier entry for it.
+
+    """
+    with _locked(path, fcntl.LOCK_EX):
+        with h5py.File(path, 'a') as f:
+            if GROUP not in f:
+                group = f.create_group(GROUP)
+                group.create_dataset('read_ids', shape=(0,), maxshape=(None,), dtype=READ_IDS_DTYPE,
+                                     chunks=(CHUNK_SIZE,), compression='lzf', shuffle=True)
+                group.create_dataset('rcs', shape=(0, 2), maxshape=(None, 2), dtype=RCS_DTYPE,
+                                     chunks=(CHUNK_SIZE, 2), compression='lzf', shuffle=True)
+                group.create_dataset('image_indexes', shape=(0,), maxshape=(None,), dtype=h5py.special_dtype(vlen=str))
+                group.create_dataset('image_ranges', shape=(0, 2), maxshape=(None, 2), dtype=np.int64)
+                group.attrs['read_names_index'] = tile_store.directory
+                group.attrs['read_names_size'] = tile_store.source['size']
+                group.attrs['read_names_mtime'] = tile_store.source['mtime']
+            group = f[GROUP]
+            if group.attrs['read_names_index'] != tile_store.directory:
+                raise ValueError("%s has reads from %s, not %s" % (path, group.attrs['read_names_index'], tile_store.directory))
+            start = group['read_ids'].shape[0]
+            stop = start + len(read_ids)
+            for name, data in (('read_ids', read_ids), ('rcs', rcs)):
+                group[name].resize(stop, axis=0)
+                group[name][start:stop] = data
+            image_count = group['image_indexes'].shape[0]
+            for name in ('image_indexes', 'image_ranges'):
+                group[name].resize(image_count + 1, axis=0)
+            group['image_indexes'][image_count] = image_index
+            group['image_ranges'][image_count] = start, stop
+
+
+def image_ranges(path):
+    """ Returns the {image index: (start, stop)} range of the reads of every image in the file. """
+    if not os.path.exists(path):
+        return {}
+    with _locked(path, fcntl.LOCK_SH):
+        with h5py.File(path, 'r') as f:
+            if GROUP not in f:
+                return {}
+            # later entries replace earlier ones for the same image
+            return dict(zip(f[GROUP]['image_indexes'][:], map(tuple, f[GROUP]['image_ranges'][:])))
+
+
+def load(path, image_index):
+    """ Returns the read ids and the (r, c) points of the reads in an image, as arrays. """
+    start, stop = image_ranges(path)[image_index]
+    with _locked(path, fcntl.LOCK_SH):
+        with h5py.File(path, 'r') as f:
+            return f[GROUP]['read_ids'][start:stop], f[GROUP]['rcs'][start:stop]
+
+
+def load_read_names(path):
+    """
+    Attaches to the read names that the ids in the file refer to. Raises ValueError if the tile index that they came from
+    was rebuilt since, because the ids would point to the wrong reads.
+
+    """
+    with _locked(path, fcntl.LOCK_SH):
+        with h5py.File(path, 'r') as f:
+            attrs = f[GROUP].attrs
+            directory, source = attrs['read_names_index'], {'size': attrs['read_names_size'], 'mtime': attrs['read_names_mtime']}
+    store = tilestore.open_index(directory)
+    if store is None or store.source != source:
+        raise ValueError("The read names index at %s has changed since %s was written." % (directory, path))
+    return store.read_names
+
+
+def load_read_names_and_points(path, image_index, read_names=None):
+    """ Like misc.read_names_and_points_given_rcs_fpath. Pass the result of load_read_names when loading many images. """
+    read_ids, rcs = load(path, image_index)
+    read_names = read_names if read_names is not None else load_read_names(path)
+    return read_names.take(read_ids), rcs.astype(np.float)
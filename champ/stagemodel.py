@@ -0,0 +1,118 @@
+import logging
+import numpy as np
+from champ import misc
+
+log = logging.getLogger(__name__)
+# The model is only fit once this many images (in at least two columns) have been aligned
+MIN_ALIGNMENTS = 5
+
+
+class StageModel(object):
+    """
+    Predicts the alignment of every field of view from its row and column. The microscope stage moves in regular steps,
+    so the offset of a tile in an image is a linear function of the row and column:
+
+        rc_offset = tile_offset + row * row_step + column * column_step
+
+    The steps are shared by all tiles, while each tile has its own offset. Rotation, scale and tile width don't change
+    from one image to the next, so we just use the median of the scale and tile width and the mean of the rotation for
+    each tile.
+
+    """
+    def __init__(self, row_step, column_step, tiles, exclusive_hits=None):
+        self.row_step = np.array(row_step, dtype=np.float)
+        self.column_step = np.array(column_step, dtype=np.float)
+        # tile key: (scaling, tile_width, rotation, tile_offset)
+        self.tiles = tiles
+        # the median number of exclusive hits of the images that the model was fit to, which a predicted alignment is
+        # compared to
+        self.exclusive_hits = exclusive_hits
+
+    @classmethod
+    def fit(cls, observations):
+        """
+        Fits the model to (row, column, AlignmentStats) tuples from images that were already aligned. Returns None if there
+        aren't enough of them to determine the stage steps.
+
+        """
+        observations = list(observations)
+        if len(observations) < MIN_ALIGNMENTS or len(set(column for _, column, _ in observations)) < 2:
+            return None
+        tile_keys = sorted(set(tile_key for _, _, astats in observations for tile_key, _, _, _, _, _ in astats))
+        tile_indexes = {tile_key: i for i, tile_key in enumerate(tile_keys)}
+        A, b, parameters = [], [], {tile_key: [] for tile_key in tile_keys}
+        for row, column, astats in observations:
+            for tile_key, scaling, tile_width, rotation, rc_offset, _ in astats:
+                design_row = np.zeros(2 + len(tile_keys))
+                design_row[:2] = row, column
+                design_row[2 + tile_indexes[tile_key]] = 1.0
+                A.append(design_row)
+                b.append(rc_offset)
+                parameters[tile_key].append((scaling, tile_width, rotation))
+        # Solves for the row step, column step and tile offsets, for both coordinates at once
+        solution = np.linalg.lstsq(np.array(A), np.array(b), rcond=None)[0]
+        tiles = {}
+        for tile_key in tile_keys:
+            scaling, tile_width, _ = np.median(parameters[tile_key], axis=0)
+            rotation = mean_angle([rotation for _, _, rotation in parameters[tile_key]])
+            tiles[tile_key] = float(scaling), float(tile_width), float(rotation), solution[2 + tile_indexes[tile_key]]
+        exclusive_hits = float(np.median([astats.hits['exclusive'] for _, _, astats in observations]))
+        model = cls(solution[0], solution[1], tiles, exclusive_hits)
+        residuals = np.linalg.norm(np.array(b) - np.array(A).dot(solution), axis=1)
+        log.info("Fit stage model to %d alignments of %d tiles. Residuals: median %.2f, max %.2f pixels"
+                 % (len(observations), len(tile_keys), np.median(residuals), residuals.max()))
+        return model
+
+    def predict(self, row, column, image_shape, tile_bounds):
+        """
+        Predicts the alignment of each tile whose reads (bounded by the (rcs_min, rcs_max) values in tile_bounds) would
+        overlap an image with the given shape at this position on the stage.
+
+        Returns a list of (tile_key, scaling, tile_width, rotation, rc_offset) tuples, like the ones an AlignmentStats yields.
+
+        """
+        alignments = []
+        for tile_key, (scaling, tile_width, rotation, tile_offset) in sorted(self.tiles.items()):
+            if tile_key not in tile_bounds:
+                continue
+            rc_offset = self.predict_offset(tile_key, row, column)
+            (r_min, c_min), (r_max, c_max) = tile_bounds[tile_key]
+            corners = misc.similarity_transform(np.array([(r_min, c_min), (r_min, c_max), (r_max, c_min), (r_max, c_max)]),
+                                                scaling, rotation, rc_offset)
+            if np.all(corners.max(axis=0) >= 0) and np.all(corners.min(axis=0) < np.array(image_shape)):
+                alignments.append((tile_key, scaling, tile_width, rotation, rc_offset))
+        return alignments
+
+    def predict_offset(self, tile_key, row, column):
+        return self.tiles[tile_key][3] + row * self.row_step + column * self.column_step
+
+    def log_residuals(self, image_index, row, column, astats):
+        # Large residuals mean that the stage has drifted since the model was fit
+        for tile_key, _, _, _, rc_offset, _ in astats:
+            if tile_key in self.tiles:
+                residual = np.linalg.norm(np.array(rc_offset) - self.predict_offset(tile_key, row, column))
+                log.debug("Stage model residual for %s %s: %.2f pixels" % (image_index, tile_key, residual))
+
+    def to_dict(self):
+        # Plain types only, so that this can be saved in the run cache
+        return {'row_step': [float(v) for v in self.row_step],
+                'column_step': [float(v) for v in self.column_step],
+                'tiles': {str(tile_key): [scaling, tile_width, rotation, [float(v) for v in tile_offset]]
+                          for tile_key, (scaling, tile_width, rotation, tile_offset) in self.tiles.items()},
+                'exclusive_hits': self.exclusive_hits}
+
+    @classmethod
+    def from_dict(cls, data):
+        tiles = {tile_key: (scaling, tile_width, rotation, np.array(tile_offset))
+                 for tile_key, (scaling, tile_width, rotation, tile_offset) in data['tiles'].items()}
+        # models saved before the hits were kept predict alignments without checking their hits
+        return cls(data['row_step'], data['column_step'], tiles, data.get('exclusive_hits'))
+
+
+def mean_angle(angles):
+    """
+    The mean of angles in radians, taking into account that they wrap around. With a rotation estimate of 180 degrees, the
+    rotations of the alignments end up on either side of -pi and pi, and their plain mean or median is 0.
+
+    """
+    return float(np.angle(np.mean(np.exp(1j * np.asarray(angles)))))
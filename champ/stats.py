@@ -16,20 +16,37 @@ class AlignmentStats(object):
         self._validate_data()
         return self
 
+    def from_string(self, serialized):
+        # the same format as the files, as kept in the alignment ledger
+        self._data = yaml.load(serialized)
+        self._validate_data()
+        return self
+
     def _validate_data(self):
         if not len(self._data['tile_keys']) == len(self._data['scalings']) == len(self._data['tile_widths']) == len(self._data['rotations']) == len(self._data['rc_offsets']):
             raise ValueError("Corrupt or invalid AlignmentStats file")
 
-    def from_data(self, tile_keys, scalings, tile_widths, rotations, rc_offsets, hits):
+    def from_data(self, tile_keys, scalings, tile_widths, rotations, rc_offsets, hits, predicted=False):
         self._data['tile_keys'] = tile_keys
         self._data['scalings'] = scalings
         self._data['tile_widths'] = tile_widths
         self._data['rotations'] = [rotation * np.pi / 180 for rotation in rotations]
         self._data['rc_offsets'] = rc_offsets
         self._data['hits'] = hits
+        self._data['predicted'] = predicted
         self._validate_data()
         return self
 
+    @property
+    def hits(self):
+        return self._data['hits']
+
+    @property
+    def predicted(self):
+        # Whether the image was aligned near a predicted alignment instead of with a rough alignment over whole tiles. Stats
+        # files from before this was recorded count as rough alignments.
+        return self._data.get('predicted', False)
+
     @property
     def score(self):
         # A somewhat arbitrary metric to determine if one alignment is better than another
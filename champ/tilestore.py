@@ -0,0 +1,230 @@
+import errno
+import fcntl
+import logging
+import os
+import shutil
+import tempfile
+import uuid
+from collections import defaultdict
+import numpy as np
+import yaml
+from champ.fastqtilercs import FastqTileReads
+from champ.readnames import ReadNames
+from champ import readnames
+
+log = logging.getLogger(__name__)
+# RAM-backed, so memory-mapped stores here are effectively shared memory
+SHARED_MEMORY_DIRECTORY = '/dev/shm'
+# The index of a read names file is kept in a directory next to it with this suffix
+INDEX_SUFFIX = '.tiles'
+INDEX_MANIFEST = 'index.yml'
+# Indexes in an older format are rebuilt
+INDEX_VERSION = 2
+# Read coordinates fit in 32 bits, which halves the memory of the largest arrays
+RCS_DTYPE = np.int32
+
+# Tiles that this process has already attached to, keyed by (store directory, tile key)
+_attached_tiles = {}
+# The read names of each store that this process has attached to, keyed by store directory
+_attached_read_names = {}
+
+
+class TileStore(object):
+    """
+    The read names and coordinates of every tile, saved in files that worker processes memory-map instead of getting
+    their own pickled copy of every read on the chip. Pickling a TileStore only sends the directory and the range of reads
+    of each tile, so it can be bound into the functions that we hand to multiprocessing pools.
+
+    The names of all reads are in one blob (see readnames.ReadNames), one tile after the other, and each read's id is its
+    position in it. Coordinates are in one .npy file per tile.
+
+    Temporary stores are deleted when they are closed, while indexes stay on disk for the next run.
+
+    """
+    def __init__(self, directory, tile_ranges, temporary=True, source=None):
+        self.directory = directory
+        # tile key: (first read id, last read id + 1)
+        self.tile_ranges = tile_ranges
+        self.keys = sorted(tile_ranges)
+        self.temporary = temporary
+        # the signature of the read names file that an index was built from
+        self.source = source
+
+    def __contains__(self, key):
+        return key in self.keys
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _path(self, key, kind):
+        return os.path.join(self.directory, '%s.%s.npy' % (key, kind))
+
+    def tile_reads(self, key):
+        """ Attaches to the arrays of one tile. This only happens once per process. """
+        attached_key = (self.directory, key)
+        if attached_key not in _attached_tiles:
+            read_names = self.read_names.subset(*self.tile_ranges[key])
+            rcs = np.load(self._path(key, 'rcs'), mmap_mode='r')
+            _attached_tiles[attached_key] = FastqTileReads(key, read_names, rcs, read_names.read_ids, self.signature)
+        return _attached_tiles[attached_key]
+
+    @property
+    def read_names(self):
+        """ The names of every read in the store, which can be looked up by read id. """
+        if self.directory not in _attached_read_names:
+            _attached_read_names[self.directory] = ReadNames.load(self.directory)
+        return _attached_read_names[self.directory]
+
+    @property
+    def signature(self):
+        """ Identifies the reads in the store. Indexes are rebuilt when their read names change, temporary stores never are. """
+        if self.source is None:
+            return self.directory, None
+        return self.directory, self.source['size'], self.source['mtime']
+
+    @property
+    def tile_bounds(self):
+        # The smallest and largest coordinates of the reads in each (non-empty) tile
+        bounds = {}
+        for key in self.keys:
+            reads = self.tile_reads(key)
+            if len(reads.rcs):
+                bounds[key] = reads.rcs_min, reads.rcs_max
+        return bounds
+
+    @property
+    def read_count(self):
+        return sum(stop - start for start, stop in self.tile_ranges.values())
+
+    def close(self):
+        """ Deletes the files of a temporary store. Processes that are still attached keep their mappings until they exit. """
+        for key in self.keys:
+            _attached_tiles.pop((self.directory, key), None)
+        _attached_read_names.pop(self.directory, None)
+        if self.temporary:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def create(tile_data, name='tiles'):
+    """
+    Writes the reads of each tile in a {tile_key: [read names]} dictionary (see parse_read_names) to a new store in
+    shared memory, falling back to the regular temporary directory where there is no /dev/shm.
+
+    """
+    parent = SHARED_MEMORY_DIRECTORY if os.path.isdir(SHARED_MEMORY_DIRECTORY) else None
+    directory = tempfile.mkdtemp(prefix='champ-%s-' % name, dir=parent)
+    store = TileStore(directory, write_tiles(directory, tile_data))
+    log.debug("Stored %d tiles of %s reads in %s" % (len(store), name, directory))
+    return store
+
+
+def write_tiles(directory, tile_data):
+    """ Writes the reads of each tile in a {tile_key: [read names]} dictionary, and returns the range of each tile. """
+    for key, read_names in tile_data.items():
+        reads = FastqTileReads(key, read_names)
+        np.save(os.path.join(directory, '%s.rcs.npy' % key), reads.rcs.astype(RCS_DTYPE))
+    return readnames.write(directory, [(key, tile_data[key]) for key in sorted(tile_data)])
+
+
+def load_index(read_names_filepath):
+    """
+    Attaches to the index of a read names file, building it first if it doesn't exist or the file has changed since. The
+    index is kept next to the read names, so they only ever have to be parsed once.
+
+    """
+    directory = read_names_filepath + INDEX_SUFFIX
+    source = _source_signature(read_names_filepath)
+    manifest = _load_manifest(directory)
+    if not _is_current(manifest, source):
+        # Only one process (of all of the machines in a shared run) rebuilds the index. The others wait for it, and then
+        # find the new index when they look again.
+        with open(directory + '.lock', 'a') as lock_file:
+            fcntl.lockf(lock_file, fcntl.LOCK_EX)
+            try:
+                manifest = _load_manifest(directory)
+                if not _is_current(manifest, source):
+                    build_index(read_names_filepath, directory, source)
+                    manifest = _load_manifest(directory)
+            finally:
+                fcntl.lockf(lock_file, fcntl.LOCK_UN)
+    else:
+        log.debug("Using the tile index of %s" % read_names_filepath)
+    return TileStore(directory, manifest['tile_ranges'], temporary=False, source=manifest['source'])
+
+
+def open_index(directory):
+    """ Attaches to an existing index without checking its read names file. Returns None if there is no index there. """
+    manifest = _load_manifest(directory)
+    if manifest is None or manifest.get('version') != INDEX_VERSION:
+        return None
+    return TileStore(directory, manifest['tile_ranges'], temporary=False, source=manifest['source'])
+
+
+def build_index(read_names_filepath, directory, source):
+    log.debug("Indexing %s" % read_names_filepath)
+    tiles = parse_read_names(read_names_filepath)
+    # The index is written somewhere else first and then moved into place, so other processes never see half of one
+    building_directory = tempfile.mkdtemp(prefix=os.path.basename(directory) + '.', dir=os.path.dirname(directory))
+    tile_ranges = write_tiles(building_directory, tiles)
+    with open(os.path.join(building_directory, INDEX_MANIFEST), 'w') as f:
+        yaml.dump({'version': INDEX_VERSION, 'source': source, 'tile_ranges': tile_ranges}, f)
+    stale_directory = None
+    if os.path.isdir(directory):
+        # It's out of date. It's moved out of the way in one step instead of being deleted in place, so no process ever
+        # finds half of it.
+        stale_directory = '%s.stale.%s' % (directory, uuid.uuid4().hex[:8])
+        os.rename(directory, stale_directory)
+    try:
+        os.rename(building_directory, directory)
+    except OSError as e:
+        if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+            raise
+        # a process that doesn't take the lock built it at the same time
+        shutil.rmtree(building_directory, ignore_errors=True)
+    if stale_directory is not None:
+        # processes that had it open keep their memory maps
+        shutil.rmtree(stale_directory, ignore_errors=True)
+    log.debug("Indexed %d tiles of %s" % (len(tile_ranges), read_names_filepath))
+
+
+def parse_read_names(read_names_filepath):
+    """
+    Reads a file of Illumina read names, and returns the names of the reads in each tile in the order of the file, as a
+    {tile_key: [read names]} dictionary. A read is only included once.
+
+    """
+    tiles = defaultdict(list)
+    seen = set()
+    with open(read_names_filepath) as f:
+        for line in f:
+            read_name = line.strip()
+            try:
+                lane, tile = read_name.rsplit(':', 4)[1:3]
+            except ValueError:
+                if read_name:
+                    log.warn("Invalid line in read file: %s" % read_names_filepath)
+                    log.warn("The invalid line was: %s" % line)
+                continue
+            if read_name in seen:
+                continue
+            seen.add(read_name)
+            tiles['lane{0}tile{1}'.format(lane, tile)].append(read_name)
+    return tiles
+
+
+def _is_current(manifest, source):
+    return manifest is not None and manifest.get('version') == INDEX_VERSION and manifest['source'] == source
+
+
+def _source_signature(read_names_filepath):
+    # Changes whenever the read names file is replaced or rewritten
+    status = os.stat(read_names_filepath)
+    return {'size': status.st_size, 'mtime': status.st_mtime}
+
+
+def _load_manifest(directory):
+    try:
+        with open(os.path.join(directory, INDEX_MANIFEST)) as f:
+            return yaml.load(f)
+    except (IOError, yaml.YAMLError):
+        return None
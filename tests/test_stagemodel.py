@@ -0,0 +1,45 @@
+import unittest
+import numpy as np
+from champ import stats, stagemodel
+
+TILE_KEY = 'lane1tile2105'
+SCALING = 0.125
+TILE_BOUNDS = {TILE_KEY: ((1000.0, 1000.0), (29000.0, 29000.0))}
+
+
+def make_observation(row, column, rotation_degrees, exclusive_hits=1900):
+    rc_offset = (2000.0 + 400.0 * row, 2000.0 + 400.0 * column)
+    hits = {'exclusive': exclusive_hits, 'good_mutual': 0, 'bad_mutual': 0, 'non_mutual': 0}
+    astats = stats.AlignmentStats().from_data([TILE_KEY], [SCALING], [935.0], [rotation_degrees], [rc_offset], hits)
+    return row, column, astats
+
+
+class StageModelTests(unittest.TestCase):
+    def test_mean_angle_wraps_around(self):
+        self.assertAlmostEqual(abs(stagemodel.mean_angle([-np.pi + 0.01, np.pi - 0.01, np.pi - 0.01])), np.pi - 0.01 / 3, places=5)
+        self.assertAlmostEqual(stagemodel.mean_angle([0.1, -0.1, 0.3]), 0.1, places=2)
+
+    def test_fit_with_rotations_on_both_sides_of_pi(self):
+        # like an alignment with a rotation estimate of 180 degrees, where half of them come out at -pi and half at pi
+        observations = [make_observation(row, column, 179.999 if (row + column) % 2 else -179.999)
+                        for row in range(2) for column in range(3)]
+        model = stagemodel.StageModel.fit(observations)
+        rotation = model.tiles[TILE_KEY][2]
+        self.assertAlmostEqual(abs(rotation), np.pi, places=3)
+        alignments = model.predict(1, 3, (512, 512), TILE_BOUNDS)
+        self.assertEqual([alignment[0] for alignment in alignments], [TILE_KEY])
+        np.testing.assert_allclose(alignments[0][4], (2400.0, 3200.0), atol=1e-6)
+
+    def test_exclusive_hits_are_saved(self):
+        observations = [make_observation(row, column, 180.0, exclusive_hits=1800 + 50 * column)
+                        for row in range(2) for column in range(3)]
+        model = stagemodel.StageModel.fit(observations)
+        self.assertEqual(model.exclusive_hits, 1850)
+        self.assertEqual(stagemodel.StageModel.from_dict(model.to_dict()).exclusive_hits, 1850)
+        old_data = model.to_dict()
+        del old_data['exclusive_hits']
+        self.assertIsNone(stagemodel.StageModel.from_dict(old_data).exclusive_hits)
+
+
+if __name__ == '__main__':
+    unittest.main()